@@ -0,0 +1,43 @@
+"""
+ASGI config for global_server project.
+
+It exposes the ASGI callable as a module-level variable named ``application``, to be
+served by an ASGI server, e.g. ``uvicorn global_server.asgi:application``.
+
+Django 1.11 only runs synchronous views, so the requests are read and answered by the
+event loop of the server and the views run in a pool of settings.ASGI_THREADS threads.
+Slow clients and idle keep-alive connections then wait in the event loop instead of
+holding a thread each.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "global_server.settings")
+
+http_application = WsgiToAsgi(get_wsgi_application())
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # the views run in the default executor of the event loop
+            executor = ThreadPoolExecutor(settings.ASGI_THREADS)
+            asyncio.get_event_loop().set_default_executor(executor)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    else:
+        await http_application(scope, receive, send)
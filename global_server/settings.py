@@ -31,7 +31,7 @@ ALLOWED_HOSTS = []
 # Application definition
 
 INSTALLED_APPS = [
-    'rest_app',
+    'rest_app.apps.RestAppConfig',
     'rest_framework',
     'django.contrib.admin',
     'django.contrib.auth',
@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'rest_app.middleware.MetricsMiddleware',
+    'rest_app.middleware.ServerTimingMiddleware',
     'rest_app.middleware.SignResponseMiddleware',
 #    'rest_app.middleware.VerifySignatureMiddleware',
 #    'rest_app.middleware.VerifyAuthoriztion',
@@ -77,12 +79,66 @@ WSGI_APPLICATION = 'global_server.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
+#
+# SQLite is used unless DATABASE_ENGINE=postgresql is set in the environment, in
+# which case the connection is configured by the other DATABASE_* variables.
+# Each worker thread keeps its connection open for DATABASE_CONN_MAX_AGE seconds
+# instead of opening a new one for every request. To pool the connections across
+# workers, point DATABASE_HOST/DATABASE_PORT at a PgBouncer and set
+# DATABASE_POOLER=pgbouncer
+
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite3')
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DATABASE_NAME', 'global_server'),
+            'USER': os.environ.get('DATABASE_USER', ''),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', ''),
+            'PORT': os.environ.get('DATABASE_PORT', ''),
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 600)),
+            # server-side cursors don't survive the transaction pooling of PgBouncer
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DATABASE_POOLER') == 'pgbouncer',
+        }
+    }
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    if os.environ.get('DATABASE_REPLICA_HOST'):
+        DATABASES['replica'] = dict(DATABASES['default'],
+                                    HOST=os.environ['DATABASE_REPLICA_HOST'],
+                                    PORT=os.environ.get('DATABASE_REPLICA_PORT', ''),
+                                    TEST={'MIRROR': 'default'})
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        }
     }
+# The read only views decorated with read_from_replica (get-pending) read from the
+# 'replica' database when DATABASE_REPLICA_HOST is set. A user that wrote something
+# reads from the primary for the next REPLICA_PIN_SECONDS, so they always see their own
+# writes; this is only known by the process that served the write, so get-pending also
+# reads from the primary when the user already got a newer version of the group than
+# the replica has. get-totals reads the primary, since what it reads is cached (see
+# TOTALS_CACHE)
+
+DATABASE_ROUTERS = ['rest_app.routers.ReplicaRouter']
+REPLICA_DATABASE = 'replica' if 'replica' in DATABASES else None
+REPLICA_PIN_SECONDS = 5
+
+# Pragmas set on every new SQLite connection, for single node deployments that stay on
+# SQLite. WAL lets readers go on while accept writes, and busy_timeout (in ms) makes
+# writers wait for each other instead of failing with "database is locked".
+# Set it to {} to keep the SQLite defaults
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,  # in KiB when negative, so 64MB
+    'mmap_size': 268435456,  # 256MB
+    'busy_timeout': 5000,
 }
 
 
@@ -123,3 +179,107 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Debt simplification
+# One of the strategies in rest_app.utils.simplify_debt.STRATEGIES:
+#  'sorted' settles users by the order of their keys,
+#  'fewest_transactions' settles the biggest debts first,
+#  'stable' changes as little as possible of the previous simplified debt
+
+DEBT_SIMPLIFICATION_STRATEGY = 'sorted'
+
+
+# Signature verification
+# Maximum number of serialized public keys, and whether they are malformed, kept in
+# memory by each process (see rest_app.signatures.public_keys)
+
+PUBLIC_KEY_CACHE_SIZE = 4096
+
+# Successfully verified signatures are remembered by each process, so that retried
+# requests with the same signed envelope are not verified again. The least recently
+# used entries are evicted beyond MAX_SIZE and entries expire after TTL seconds.
+# Set MAX_SIZE to 0 to disable it
+
+VERIFIED_SIGNATURE_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 300,
+}
+
+
+# Response signing
+# Only the responses to paths (without the script prefix) matching one of these
+# regexes are signed by the server
+
+SIGNED_RESPONSE_PATHS = [r'^/rest/']
+
+# None signs the responses in the request thread. 'process' signs them in a pool of
+# RESPONSE_SIGNING_WORKERS processes: the signing is pure python and holds the GIL, so
+# only other processes sign the responses of the ASGI_THREADS threads in parallel
+
+RESPONSE_SIGNING_POOL = os.environ.get('RESPONSE_SIGNING_POOL') or None
+RESPONSE_SIGNING_WORKERS = 4
+
+
+# Totals cache
+# The balances and the simplified debt of each group, from which get-totals answers
+# without reading the database. With BACKEND None, each process keeps them for the
+# MAX_SIZE / 2 most recently used groups (0 disables it). BACKEND can also be the name
+# of a cache in CACHES, shared by all the processes
+
+TOTALS_CACHE = {
+    'BACKEND': None,
+    'MAX_SIZE': 4096,
+}
+
+
+# Long polling
+# Maximum number of seconds uome/wait-pending/ holds a request open waiting for new
+# pending UOMe's. Each waiting request holds a worker thread, so at most
+# LONG_POLL_MAX_WAITERS of them wait at once in each process (half of ASGI_THREADS),
+# the others are answered 429 right away. Only the requests that write in the same
+# process wake up the waiting requests, the others answer after the timeout
+
+LONG_POLL_TIMEOUT = 30
+LONG_POLL_MAX_WAITERS = 16
+
+
+# ASGI
+# Number of threads global_server.asgi runs the views in. Bounds the requests being
+# handled at once by each process, the rest wait in the event loop of the server
+
+ASGI_THREADS = 32
+
+
+# Server timing
+# When on, every response gets a Server-Timing header with the milliseconds spent in
+# verifying signatures, in the database, in simplifying the debt, in encoding JSON and
+# in signing the response, and the same timings are logged by rest_app.middleware.
+# When off the middleware is not even loaded
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '') == '1'
+
+
+# Metrics
+# Requests, latency, signature verifications and database queries of each view, and
+# the size of the groups at accept, served at /metrics in the Prometheus format. Off by
+# default, since counting the queries makes the connections use debug cursors. The
+# metrics are not signed, so they are only served to scrapers that send METRICS_TOKEN
+# as a bearer token; the address of every client is the load balancer's. Without a
+# token they are not served at all
+
+METRICS = os.environ.get('METRICS', '') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
+# Query budgets
+# The views decorated with rest_app.decorators.query_budget log their queries when they
+# make more queries than their budget or spend more than QUERY_BUDGET_SECONDS on them.
+# In strict mode (set by global_server.test_settings), going over the number of queries
+# fails the request instead, and the logged queries come with the stack traces that
+# made them. Checking the budgets makes the connections use debug cursors, so it is
+# only on while debugging or in strict mode
+
+QUERY_BUDGET_SECONDS = 0.5
+QUERY_BUDGET_STRICT = os.environ.get('QUERY_BUDGET_STRICT', '') == '1'
+QUERY_BUDGETS = DEBUG or QUERY_BUDGET_STRICT
@@ -0,0 +1,9 @@
+"""
+Settings of the tests (see pytest.ini)
+"""
+
+from global_server.settings import *  # noqa: F401,F403
+
+# going over a query budget fails the request, see rest_app.decorators.query_budget
+QUERY_BUDGET_STRICT = True
+QUERY_BUDGETS = True
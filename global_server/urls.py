@@ -16,7 +16,10 @@ Including another URLconf
 from django.conf.urls import include, url
 from django.contrib import admin
 
+from rest_app.views import expose_metrics
+
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^rest/', include('rest_app.urls')),
+    url(r'^metrics$', expose_metrics, name='metrics'),
 ]
@@ -1,5 +1,41 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+
+
+def invalidate_public_key(sender, instance, **kwargs):
+    from rest_app.signatures import public_keys
+    public_keys.invalidate(instance.key)
+
+
+def invalidate_group_totals(sender, instance, **kwargs):
+    from rest_app.totals import totals_cache
+    totals_cache.invalidate(str(instance.group_id))
+
+
+def set_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        # with the cursor of the database driver, so that setting up the connection is
+        # not logged as queries of the request that opened it (see rest_app.queries)
+        cursor = connection.connection.cursor()
+        try:
+            for pragma, value in settings.SQLITE_PRAGMAS.items():
+                cursor.execute('PRAGMA %s = %s' % (pragma, value))
+        finally:
+            cursor.close()
 
 
 class RestAppConfig(AppConfig):
     name = 'rest_app'
+
+    def ready(self):
+        post_delete.connect(invalidate_public_key, sender=self.get_model('User'),
+                            dispatch_uid='invalidate_user_public_key')
+        post_delete.connect(invalidate_public_key, sender=self.get_model('Group'),
+                            dispatch_uid='invalidate_group_public_key')
+        for model_name in ('User', 'UserDebt'):
+            for signal in (post_save, post_delete):
+                signal.connect(invalidate_group_totals, sender=self.get_model(model_name),
+                               dispatch_uid='invalidate_%s_totals' % model_name)
+        connection_created.connect(set_sqlite_pragmas, dispatch_uid='set_sqlite_pragmas')
@@ -1,9 +1,13 @@
 import logging
 
+from django.conf import settings
 from django.http import HttpResponseBadRequest, HttpResponseForbidden
 from functools import wraps
 
 import groupbank_crypto.ec_secp256k1 as crypto
+from rest_app import routers
+from rest_app.queries import QueryLog, format_stack
+from rest_app.signatures import SignatureBatch
 
 logger = logging.getLogger(__name__)
 
@@ -31,8 +35,13 @@ def verify_author(view):
         # NOTE: This does not verify if the signer is authorized for the operation.
         #       It only verifies if the signature matches the given pub key
 
+        # the views add the signatures inside the payload to the same batch, so the
+        # envelope is not verified again if they need it
+        request.signatures = SignatureBatch()
+        request.signatures.add(author, signature, payload)
+
         try:
-            crypto.verify(author, signature, payload)
+            request.signatures.verify(phase='verify_author')
             return view(request)
         except (crypto.InvalidSignature, crypto.InvalidKey):
             logger.info('Request with invalid author key or signature')
@@ -40,3 +49,84 @@ def verify_author(view):
             # or 401 Unauthorized...
 
     return wrapper
+
+
+# decorator for views that only read, so that they use the read replica if there is one
+def read_from_replica(view):
+
+    @wraps(view)
+    def wrapper(request):
+        # users that wrote recently read from the primary so they always see their writes
+        if not settings.REPLICA_DATABASE or \
+                routers.is_pinned_to_primary(request.POST.get('author')):
+            return view(request)
+
+        with routers.use_replica():
+            return view(request)
+
+    return wrapper
+
+
+# decorator for views that write, so that the author reads their own writes afterwards
+def pin_author_to_primary(view):
+
+    @wraps(view)
+    def wrapper(request):
+        response = view(request)
+
+        if settings.REPLICA_DATABASE and 200 <= response.status_code < 300:
+            routers.pin_to_primary(request.POST['author'])
+
+        return response
+
+    return wrapper
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# decorator for views with a fixed number of queries, so that N+1 queries don't creep in
+def query_budget(queries: int, seconds: float = None):
+    """
+    The view may make at most `queries` queries, which may take at most `seconds` in
+    total (settings.QUERY_BUDGET_SECONDS by default). Going over the budget logs every
+    query of the request. While testing, making too many queries raises
+    QueryBudgetExceeded instead, and the queries are logged with the stack trace that
+    made them; the time of the queries is only logged then, since it depends on the
+    machine running the tests. Does nothing unless settings.QUERY_BUDGETS is on
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(request):
+            if not settings.QUERY_BUDGETS:
+                return view(request)
+
+            query_log = QueryLog(record_stacks=settings.QUERY_BUDGET_STRICT)
+            query_log.start()
+            try:
+                response = view(request)
+            finally:
+                count, query_time = query_log.stop()
+
+            max_seconds = seconds if seconds is not None else settings.QUERY_BUDGET_SECONDS
+            if count <= queries and query_time <= max_seconds:
+                return response
+
+            message = '%s made %d queries in %.3fs, over its budget of %d queries in %.3fs' \
+                      % (view.__name__, count, query_time, queries, max_seconds)
+            logger.warning('%s\n%s' % (message, '\n'.join(
+                '%s (%ss)\n%s' % (query['sql'], query['time'],
+                                   format_stack(query.get('stack', [])))
+                for query in query_log.queries)))
+
+            if settings.QUERY_BUDGET_STRICT and count > queries:
+                raise QueryBudgetExceeded(message)
+
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,139 @@
+"""
+In-process metrics, exposed in the Prometheus text format by the metrics view.
+Every process of the server keeps its own, so each one has to be scraped
+"""
+import threading
+from collections import defaultdict
+
+_state = threading.local()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+GROUP_SIZE_BUCKETS = (2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = ['%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+class Counter(object):
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = defaultdict(int)  # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] += amount
+
+    def value(self, *label_values) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def expose(self) -> list:
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s counter' % self.name]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append('%s%s %s' % (self.name,
+                                          _format_labels(self.labels, label_values),
+                                          repr(value)))
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name: str, documentation: str, buckets: tuple, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count of each bucket (not cumulative), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        bucket = len(self.buckets)  # +Inf
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                bucket = i
+                break
+
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts[0][bucket] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def count(self, *label_values) -> int:
+        with self._lock:
+            return self._values[label_values][2] if label_values in self._values else 0
+
+    def expose(self) -> list:
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for label_values, (buckets, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for upper_bound, bucket_count in zip(self.buckets + ('+Inf',), buckets):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (
+                        self.name,
+                        _format_labels(self.labels, label_values, 'le="%s"' % upper_bound),
+                        cumulative))
+                labels = _format_labels(self.labels, label_values)
+                lines.append('%s_sum%s %s' % (self.name, labels, repr(total)))
+                lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+requests = Counter('groupbank_requests_total', 'Requests by view and status',
+                   ('view', 'status'))
+request_latency = Histogram('groupbank_request_duration_seconds',
+                            'Time to answer a request, by view', LATENCY_BUCKETS, ('view',))
+signature_verifications = Counter('groupbank_signature_verifications_total',
+                                  'Signatures verified by the crypto library (not cached)',
+                                  ('view',))
+db_queries = Counter('groupbank_db_queries_total', 'Database queries by view', ('view',))
+accept_group_size = Histogram('groupbank_accept_group_size',
+                              'Users of the group of each accepted UOMe batch',
+                              GROUP_SIZE_BUCKETS)
+
+REGISTRY = (requests, request_latency, signature_verifications, db_queries,
+            accept_group_size)
+
+
+def expose() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def start_request() -> None:
+    _state.verifications = 0
+
+
+def count_verification() -> None:
+    """
+    Counts a signature verification of the current request, if it is being measured
+    """
+    if getattr(_state, 'verifications', None) is not None:
+        _state.verifications += 1
+
+
+def end_request() -> int:
+    """
+    Returns the number of signatures verified during the current request
+    """
+    verifications = getattr(_state, 'verifications', None) or 0
+    _state.verifications = None
+    return verifications
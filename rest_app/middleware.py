@@ -1,6 +1,18 @@
+import json
+import logging
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import HttpResponseBadRequest, HttpResponseForbidden
 
 from groupbank_crypto import ec_secp256k1 as crypto  # we might want to change the underlying crypto
+from rest_app import metrics, timing
+from rest_app.queries import QueryLog
+
+logger = logging.getLogger(__name__)
 
 
 class VerifySignatureMiddleware(object):
@@ -47,13 +59,39 @@ class VerifySignatureMiddleware(object):
             # or 401 Unauthorized...
 
 
+_worker_private_key = None
+
+
+def _load_worker_keys(keys_file: str) -> None:
+    # runs once in each process of the signing pool, so the key is never pickled
+    global _worker_private_key
+    _worker_private_key, _ = crypto.load_keys(keys_file)
+
+
+def _sign_in_worker(content: str) -> str:
+    return crypto.sign(_worker_private_key, content)
+
+
 class SignResponseMiddleware(object):
+    keys_file = 'server_keys.pem'
+
     def __init__(self, get_response):
         self.get_response = get_response
-        self.private_key, self.public_key = crypto.load_keys('server_keys.pem')
+        self.private_key, self.public_key = crypto.load_keys(self.keys_file)
         # One-time configuration and initialization.
         # Only called once when the web-server starts!
 
+        self.signed_paths = [re.compile(path) for path in settings.SIGNED_RESPONSE_PATHS]
+
+        # the signing is pure python and holds the GIL, so the responses of the threads
+        # serving requests are only signed in parallel by other processes
+        if settings.RESPONSE_SIGNING_POOL == 'process':
+            self.executor = ProcessPoolExecutor(settings.RESPONSE_SIGNING_WORKERS,
+                                                initializer=_load_worker_keys,
+                                                initargs=(self.keys_file,))
+        else:
+            self.executor = None
+
     def __call__(self, request):
         # Code to be executed for each request before
         # the view (and later middleware) are called.
@@ -63,7 +101,102 @@ class SignResponseMiddleware(object):
         # Code to be executed for each request/response after
         # the view is called.
 
+        # streaming responses would have to be consumed to be signed
+        if response.streaming or not self.must_sign(request.path_info):
+            return response
+
         response['author'] = self.public_key
-        response['signature'] = crypto.sign(self.private_key, response.content.decode())
+        with timing.phase('sign'):
+            response['signature'] = self.sign(response.content.decode(response.charset))
+
+        return response
+
+    def must_sign(self, path: str) -> bool:
+        return any(signed_path.match(path) for signed_path in self.signed_paths)
+
+    def sign(self, content: str) -> str:
+        if self.executor is None:
+            return crypto.sign(self.private_key, content)
+        # the request thread releases the GIL while it waits for the signature
+        return self.executor.submit(_sign_in_worker, content).result()
+
+
+class MetricsMiddleware(object):
+    """
+    Records the requests, latency, signature verifications and database queries of
+    each view in rest_app.metrics. Must be the first middleware, so that the latency
+    includes all of them. Only used when settings.METRICS is on
+    """
+
+    def __init__(self, get_response):
+        if not settings.METRICS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        query_log = QueryLog()
+        query_log.start()
+        metrics.start_request()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            latency = time.perf_counter() - start
+            verifications = metrics.end_request()
+            queries, _ = query_log.stop()
+
+        # only known after the URL is resolved, inside get_response
+        if request.resolver_match is not None:
+            view = request.resolver_match.view_name
+        else:
+            view = 'unresolved'
+
+        metrics.requests.inc(view, response.status_code)
+        metrics.request_latency.observe(latency, view)
+        if verifications:
+            metrics.signature_verifications.inc(view, amount=verifications)
+        if queries:
+            metrics.db_queries.inc(view, amount=queries)
+
+        return response
+
+
+class ServerTimingMiddleware(object):
+    """
+    Times the phases of each request (see rest_app.timing) and its database queries,
+    and reports them in a Server-Timing header and in a log line. Must come before
+    SignResponseMiddleware, so that the signing of the response is timed too. Only
+    used when settings.SERVER_TIMING is on
+    """
+
+    def __init__(self, get_response):
+        if not settings.SERVER_TIMING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        query_log = QueryLog()
+        query_log.start()
+        timing.start()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            total = time.perf_counter() - start
+            phases = timing.stop()
+            queries, query_time = query_log.stop()
+
+        phases['db'] = query_time
+        phases['total'] = total
+
+        response['Server-Timing'] = ', '.join(
+            '%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in phases.items())
+
+        logger.info(json.dumps({'path': request.path_info,
+                                'status': response.status_code,
+                                'queries': queries,
+                                'timings_ms': {name: round(seconds * 1000, 2)
+                                               for name, seconds in phases.items()},
+                                }))
 
         return response
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_uome_states(apps, schema_editor):
+    UOMe = apps.get_model('rest_app', 'UOMe')
+    UOMe.objects.exclude(borrower_signature='').update(state='accepted')
+    UOMe.objects.filter(borrower_signature='').exclude(issuer_signature='').update(
+        state='confirmed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_app', '0004_userdebt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uome',
+            name='state',
+            field=models.CharField(choices=[('issued', 'Issued'), ('confirmed', 'Confirmed'), ('accepted', 'Accepted')], default='issued', max_length=9),
+        ),
+        migrations.RunPython(set_uome_states, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='uome',
+            index=models.Index(fields=['group', 'lender', 'state'], name='uome_group_lender_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uome',
+            index=models.Index(fields=['group', 'borrower', 'state'], name='uome_group_borrower_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userdebt',
+            index=models.Index(fields=['group', 'borrower', 'lender', 'value'], name='userdebt_group_borrower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userdebt',
+            index=models.Index(fields=['group', 'lender', 'borrower', 'value'], name='userdebt_group_lender_idx'),
+        ),
+    ]
@@ -11,6 +11,9 @@ class Group(models.Model):
     name = models.CharField(max_length=80)
 
     key = models.CharField(max_length=crypto.SERIALIZED_KEY_LENGTH)
+
+    # increases every time the pending UOMe's or the totals of the group change
+    version = models.PositiveIntegerField(default=0)
     # owner_email = models.EmailField(max_length=254)
     # TODO: add proxy/name server address
     # TODO: add currency type
@@ -32,6 +35,22 @@ class User(models.Model):
 class UOMe(models.Model):
     class Meta:
         verbose_name_plural = "UOMe's"  # for the Django Admin panel
+        indexes = [
+            # pending UOMe's issued by and waiting for a user
+            models.Index(fields=['group', 'lender', 'state'],
+                         name='uome_group_lender_state_idx'),
+            models.Index(fields=['group', 'borrower', 'state'],
+                         name='uome_group_borrower_state_idx'),
+        ]
+
+    ISSUED = 'issued'  # waiting for the issuer signature
+    CONFIRMED = 'confirmed'  # signed by the issuer, waiting for the borrower
+    ACCEPTED = 'accepted'  # signed by both, counts for the totals
+    STATE_CHOICES = (
+        (ISSUED, 'Issued'),
+        (CONFIRMED, 'Confirmed'),
+        (ACCEPTED, 'Accepted'),
+    )
 
     group = models.ForeignKey(Group, on_delete=models.CASCADE)
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -52,28 +71,69 @@ class UOMe(models.Model):
     borrower_signature = models.CharField(max_length=crypto.SIGNATURE_LENGTH, default='',
                                           blank=True)
 
+    # always follows the signatures, it's only stored so that it can be indexed
+    state = models.CharField(max_length=9, choices=STATE_CHOICES, default=ISSUED)
+
     def __str__(self):
         return "%.3f€ from %s to %s: %s" % (
         int(self.value) / 100, self.borrower, self.lender, self.description)
 
+    def save(self, *args, **kwargs):
+        if self.borrower_signature:
+            self.state = UOMe.ACCEPTED
+        elif self.issuer_signature:
+            self.state = UOMe.CONFIRMED
+        else:
+            self.state = UOMe.ISSUED
+
+        super().save(*args, **kwargs)
+
     def to_dict_unconfirmed(self) -> dict:
         """
         Returns a dictionary of the relevant information of the UOMe without
          the borrower signature
         :return tuple:
         """
-        return {'group_uuid': str(self.group.uuid),
-                'lender': self.lender.key,
-                'borrower': self.borrower.key,
+        return {'group_uuid': str(self.group_id),
+                'lender': self.lender_id,
+                'borrower': self.borrower_id,
                 'value': self.value,
                 'description': self.description,
                 'uuid': str(self.uuid),
                 'issuer_signature': self.issuer_signature,
                 }
 
+    @staticmethod
+    def dicts_unconfirmed(uomes) -> list:
+        """
+        Same as to_dict_unconfirmed for every UOMe of a queryset, but with a single query
+         that only reads the needed columns (the foreign keys are the user keys)
+        :return list:
+        """
+        return [{'group_uuid': str(group_id),
+                 'lender': lender,
+                 'borrower': borrower,
+                 'value': value,
+                 'description': description,
+                 'uuid': str(uome_uuid),
+                 'issuer_signature': issuer_signature,
+                 }
+                for group_id, lender, borrower, value, description, uome_uuid, issuer_signature
+                in uomes.values_list('group_id', 'lender_id', 'borrower_id', 'value',
+                                     'description', 'uuid', 'issuer_signature')]
+
 
 class UserDebt(models.Model):
     # the debt between users after simplification
+    class Meta:
+        indexes = [
+            # cover the suggested transactions of a borrower and of a lender
+            models.Index(fields=['group', 'borrower', 'lender', 'value'],
+                         name='userdebt_group_borrower_idx'),
+            models.Index(fields=['group', 'lender', 'borrower', 'value'],
+                         name='userdebt_group_lender_idx'),
+        ]
+
     group = models.ForeignKey(Group, on_delete=models.CASCADE)
 
     borrower = models.ForeignKey(User, on_delete=models.PROTECT, related_name='debt_borrower')
@@ -0,0 +1,71 @@
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+
+class TooManyWaiters(Exception):
+    pass
+
+
+class Notifications(object):
+    """
+    In-process publish/subscribe registry keyed by (group uuid, user key). A thread
+    takes the current() counter of a key and then waits for it to change, so that a
+    publish between the two is never missed. Only notifies the threads of the process
+    that served the publishing request.
+    At most max_waiters threads wait at once (any number if it is None), so that the
+    waiting ones can't take all the threads that serve requests
+    """
+
+    def __init__(self, max_waiters: int = None):
+        self.max_waiters = max_waiters
+        self._condition = threading.Condition()
+        self._counters = {}  # (group uuid, user key) -> number of publishes
+        self._waiters = 0
+
+    @property
+    def waiters(self) -> int:
+        with self._condition:
+            return self._waiters
+
+    def current(self, group_uuid: str, user_key: str) -> int:
+        with self._condition:
+            return self._counters.get((group_uuid, user_key), 0)
+
+    def publish(self, group_uuid: str, user_keys) -> None:
+        with self._condition:
+            for user_key in user_keys:
+                key = (group_uuid, user_key)
+                self._counters[key] = self._counters.get(key, 0) + 1
+            self._condition.notify_all()
+
+    def publish_on_commit(self, group_uuid: str, user_keys) -> None:
+        """
+        Publishes once the current transaction commits, so that the subscribers can
+        already read what changed
+        """
+        user_keys = list(user_keys)
+        transaction.on_commit(lambda: self.publish(group_uuid, user_keys))
+
+    def wait(self, group_uuid: str, user_key: str, since: int, timeout: float) -> bool:
+        """
+        Waits at most timeout seconds for a publish to the key after `since`.
+        Returns whether there was one. Raises TooManyWaiters, without waiting, if
+        max_waiters threads are already waiting
+        """
+        key = (group_uuid, user_key)
+        with self._condition:
+            if self.max_waiters is not None and self._waiters >= self.max_waiters:
+                raise TooManyWaiters()
+
+            self._waiters += 1
+            try:
+                return self._condition.wait_for(
+                    lambda: self._counters.get(key, 0) != since, timeout)
+            finally:
+                self._waiters -= 1
+
+
+# new or confirmed UOMe's for the get-pending lists of each user
+pending_notifications = Notifications(settings.LONG_POLL_MAX_WAITERS)
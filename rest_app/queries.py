@@ -0,0 +1,93 @@
+import os
+import traceback
+
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorDebugWrapper
+
+_DJANGO_DIR = os.path.dirname(django.__file__)
+
+
+class _StackRecordingCursor(CursorDebugWrapper):
+    """
+    A debug cursor that also keeps the stack trace of each query it logs
+    """
+
+    def __init__(self, cursor, db, stacks: list):
+        super().__init__(cursor, db)
+        self.stacks = stacks
+
+    def execute(self, sql, params=None):
+        self.stacks.append(traceback.extract_stack()[:-1])
+        return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.stacks.append(traceback.extract_stack()[:-1])
+        return super().executemany(sql, param_list)
+
+
+class QueryLog(object):
+    """
+    Counts the queries made by the connections of this thread between start() and
+    stop(), and the seconds they took. Django 1.11 has no hook for every query, so the
+    connections log their queries with debug cursors in the meanwhile. With
+    record_stacks, the queries (see stop()) come with the stack trace that made them
+    """
+
+    def __init__(self, record_stacks: bool = False):
+        self.record_stacks = record_stacks
+        self.queries = []  # dicts with the sql, time and, maybe, the stack of each query
+
+    def start(self) -> None:
+        self._was_logging = {}
+        self._logged = {}
+        self._stacks = {}
+        self._debug_cursors = {}
+        for connection in connections.all():
+            self._was_logging[connection.alias] = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            self._logged[connection.alias] = len(connection.queries_log)
+
+            if self.record_stacks:
+                stacks = self._stacks[connection.alias] = []
+                self._debug_cursors[connection.alias] = connection.__dict__.get(
+                    'make_debug_cursor')
+                connection.make_debug_cursor = (
+                    lambda cursor, db=connection, stacks=stacks:
+                    _StackRecordingCursor(cursor, db, stacks))
+
+    def stop(self) -> (int, float):
+        """
+        Returns the number of queries and the seconds they took
+        """
+        self.queries = []
+        for connection in connections.all():
+            new_queries = list(connection.queries_log)[self._logged.get(connection.alias, 0):]
+            stacks = self._stacks.get(connection.alias)
+            for i, query in enumerate(new_queries):
+                query = dict(query, alias=connection.alias)
+                if stacks is not None and i < len(stacks):
+                    query['stack'] = stacks[i]
+                self.queries.append(query)
+
+            if connection.alias in self._debug_cursors:
+                if self._debug_cursors[connection.alias] is None:
+                    del connection.make_debug_cursor
+                else:
+                    connection.make_debug_cursor = self._debug_cursors[connection.alias]
+
+            connection.force_debug_cursor = self._was_logging.get(connection.alias, False)
+            if not connection.force_debug_cursor and not settings.DEBUG:
+                # nobody else reads the log, don't let it fill up
+                connection.queries_log.clear()
+
+        return len(self.queries), sum(float(query['time']) for query in self.queries)
+
+
+def format_stack(stack: list) -> str:
+    """
+    Formats a stack trace of a query without the frames inside Django
+    """
+    return ''.join(traceback.format_list(
+        [frame for frame in stack if not frame.filename.startswith(_DJANGO_DIR)]))
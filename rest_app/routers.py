@@ -0,0 +1,65 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from rest_app.utils.cache import LRUCache
+
+_state = threading.local()
+
+# Users that wrote recently, who read from the primary database until the replica has
+# surely caught up with their writes. Only covers the requests served by this process
+recent_writers = LRUCache(100000, ttl=settings.REPLICA_PIN_SECONDS)
+
+
+@contextmanager
+def use_replica():
+    """
+    The reads of this thread inside the block go to the replica database
+    """
+    previous, _state.use_replica = getattr(_state, 'use_replica', False), True
+    try:
+        yield
+    finally:
+        _state.use_replica = previous
+
+
+def using_replica() -> bool:
+    return bool(settings.REPLICA_DATABASE) and getattr(_state, 'use_replica', False)
+
+
+def leave_replica() -> None:
+    """
+    The rest of the reads of this thread inside the current use_replica() block go to
+    the primary database, e.g. once the replica turns out to be lagging behind
+    """
+    _state.use_replica = False
+
+
+def pin_to_primary(user_key: str) -> None:
+    recent_writers.set(user_key, True)
+
+
+def is_pinned_to_primary(user_key: str) -> bool:
+    return recent_writers.get(user_key, False)
+
+
+class ReplicaRouter(object):
+    """
+    Sends the reads made inside use_replica() to settings.REPLICA_DATABASE and
+    everything else to the default database
+    """
+
+    def db_for_read(self, model, **hints):
+        if using_replica():
+            return settings.REPLICA_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # the replica has the same data as the default database
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != settings.REPLICA_DATABASE
@@ -0,0 +1,119 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+
+from groupbank_crypto import ec_secp256k1 as crypto  # we might want to change the underlying crypto
+from rest_app import metrics, timing
+from rest_app.utils.cache import LRUCache
+
+# Process-wide cache of the serialized public keys (User.key and Group.key) that were
+# already given to the crypto library, mapped to whether they are valid keys.
+# groupbank_crypto only verifies serialized keys and parses them again in every call,
+# so this does not save parsing valid keys: it only remembers the malformed ones, which
+# are rejected without calling the library again, and counts hits and misses.
+# Shared by the verify author decorator and the views, and invalidated when the user
+# or group that owns the key is deleted
+public_keys = LRUCache(settings.PUBLIC_KEY_CACHE_SIZE)
+
+# Digests of the (key, signature, payload) triples that were successfully verified
+# recently, so that a client retrying a request with the same signed envelope costs a
+# hash lookup instead of a new verification. Failed verifications are never stored
+verified_signatures = LRUCache(settings.VERIFIED_SIGNATURE_CACHE['MAX_SIZE'],
+                               ttl=settings.VERIFIED_SIGNATURE_CACHE['TTL'])
+
+
+def _digest(key: str, signature: str, payload: str) -> bytes:
+    return hashlib.sha256(json.dumps([key, signature, payload]).encode()).digest()
+
+
+def _verify(key: str, signature: str, payload: str) -> None:
+    digest = _digest(key, signature, payload)
+    if verified_signatures.get(digest):
+        return
+
+    if public_keys.get(key) is False:  # don't load a key we know is malformed again
+        raise crypto.InvalidKey()
+
+    metrics.count_verification()
+    try:
+        crypto.verify(key, signature, payload)
+    except crypto.InvalidKey:
+        public_keys.set(key, False)
+        raise
+    except crypto.InvalidSignature:
+        public_keys.set(key, True)  # the key itself was loaded fine
+        raise
+
+    public_keys.set(key, True)
+    verified_signatures.set(digest, True)
+
+
+def verify_many(signatures) -> None:
+    """
+    Verify a list of (key, signature, payload) triples with a single call.
+    Identical triples are only verified once and the triples of the same key are
+    verified one after the other.
+    Raises crypto.InvalidKey or crypto.InvalidSignature for the first invalid triple
+    """
+    for key, signature, payload in sorted(set(signatures), key=lambda triple: triple[0]):
+        _verify(key, signature, payload)
+
+
+def check_many(signatures) -> dict:
+    """
+    Like verify_many, but verifies all the triples instead of stopping at the first
+    invalid one. Returns the invalid triples, mapped to the error they raised
+    """
+    invalid = {}
+    for triple in sorted(set(signatures), key=lambda triple: triple[0]):
+        try:
+            _verify(*triple)
+        except (crypto.InvalidKey, crypto.InvalidSignature) as error:
+            invalid[triple] = error
+    return invalid
+
+
+class SignatureBatch(object):
+    """
+    Collects the signatures a request needs verified, so that they are all checked
+    by one call to verify(). A signature that was already verified during the request
+    is not verified again
+    """
+
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._verified = set()
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._pending)
+
+    def add(self, key: str, signature: str, payload: str) -> None:
+        triple = (key, signature, payload)
+        if triple not in self._verified:
+            self._pending[triple] = None
+
+    def verify(self, optional=(), phase: str = 'verify') -> set:
+        """
+        Verify all the pending signatures, and then the optional ones, with a single
+        call. Raises crypto.InvalidKey or crypto.InvalidSignature if any of the pending
+        ones is invalid, in which case none of them is considered verified and the
+        optional ones are not even checked.
+        Returns the optional signatures that are invalid, e.g. the signatures of the
+        entries of a batch that are rejected one by one.
+        The time it takes is reported as the given timing phase
+        """
+        pending = list(self._pending)
+        optional = [triple for triple in optional
+                    if triple not in self._verified and triple not in self._pending]
+        with timing.phase(phase):
+            verify_many(pending)
+            self._verified.update(pending)
+            self._pending.clear()
+
+            invalid = check_many(optional) if optional else {}
+
+        self._verified.update(triple for triple in optional if triple not in invalid)
+        return set(invalid)
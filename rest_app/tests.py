@@ -0,0 +1,568 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+
+import pytest
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+import groupbank_crypto.ec_secp256k1 as crypto
+from rest_app import example_keys, metrics, routers, signatures, timing
+from rest_app.decorators import (QueryBudgetExceeded, pin_author_to_primary, query_budget,
+                                 read_from_replica)
+from rest_app.middleware import SignResponseMiddleware
+from rest_app.models import Group, User
+from rest_app.notifications import Notifications, TooManyWaiters
+from rest_app.totals import TotalsCache
+from rest_app.utils.cache import LRUCache
+from rest_app.signatures import SignatureBatch, public_keys, verified_signatures, verify_many
+
+
+class TestSignatureBatch:
+    def test_verify_valid_signatures(self):
+        payload = json.dumps({'user': example_keys.C1_pub})
+        batch = SignatureBatch()
+        batch.add(example_keys.C1_pub, crypto.sign(example_keys.C1_priv, payload), payload)
+        batch.add(example_keys.C2_pub, crypto.sign(example_keys.C2_priv, payload), payload)
+
+        batch.verify()
+
+    def test_verify_invalid_signature(self):
+        payload = json.dumps({'user': example_keys.C1_pub})
+        batch = SignatureBatch()
+        batch.add(example_keys.C1_pub, crypto.sign(example_keys.C1_priv, payload), payload)
+        batch.add(example_keys.C2_pub, crypto.sign(example_keys.C1_priv, payload), payload)
+
+        with pytest.raises(crypto.InvalidSignature):
+            batch.verify()
+
+        # the failed signatures are still pending
+        with pytest.raises(crypto.InvalidSignature):
+            batch.verify()
+
+    def test_identical_signatures_are_verified_once(self, monkeypatch):
+        verified_signatures.clear()
+        payload = json.dumps({'user': example_keys.C1_pub})
+        signature = crypto.sign(example_keys.C1_priv, payload)
+
+        verified = []
+        monkeypatch.setattr(crypto, 'verify', lambda *triple: verified.append(triple))
+
+        batch = SignatureBatch()
+        batch.add(example_keys.C1_pub, signature, payload)
+        batch.add(example_keys.C1_pub, signature, payload)
+        batch.verify()
+        batch.add(example_keys.C1_pub, signature, payload)
+        batch.verify()
+
+        verified_signatures.clear()  # otherwise the triple is remembered as verified
+        verify_many([(example_keys.C1_pub, signature, payload)] * 3)
+
+        assert verified == [(example_keys.C1_pub, signature, payload)] * 2
+
+    def test_optional_signatures_are_verified_in_one_call(self, monkeypatch):
+        verified_signatures.clear()
+        payload = json.dumps({'user': example_keys.C1_pub})
+        envelope = (example_keys.C1_pub, crypto.sign(example_keys.C1_priv, payload), payload)
+        valid = (example_keys.C2_pub, crypto.sign(example_keys.C2_priv, payload), payload)
+        invalid = (example_keys.C2_pub, envelope[1], payload)
+
+        calls = []
+        check_many = signatures.check_many
+        monkeypatch.setattr(signatures, 'check_many',
+                            lambda triples: calls.append(triples) or check_many(triples))
+
+        batch = SignatureBatch()
+        batch.add(*envelope)
+
+        assert batch.verify(optional=[valid, invalid]) == {invalid}
+        assert calls == [[valid, invalid]]
+        assert not batch.pending
+
+    def test_invalid_pending_signature_raises_before_checking_optional_ones(self,
+                                                                            monkeypatch):
+        payload = json.dumps({'user': example_keys.C1_pub})
+        valid = (example_keys.C2_pub, crypto.sign(example_keys.C2_priv, payload), payload)
+
+        verified = []
+        verify = crypto.verify
+        monkeypatch.setattr(crypto, 'verify',
+                            lambda *triple: verified.append(triple) or verify(*triple))
+
+        batch = SignatureBatch()
+        batch.add(example_keys.C1_pub, valid[1], payload)
+
+        with pytest.raises(crypto.InvalidSignature):
+            batch.verify(optional=[valid])
+        assert batch.pending
+        assert len(verified) == 1  # only the pending one
+
+
+class PublicKeyCacheTests(TestCase):
+    def setUp(self):
+        public_keys.clear()
+        verified_signatures.clear()
+        self.payload = json.dumps({'user': example_keys.C1_pub})
+        self.signature = crypto.sign(example_keys.C1_priv, self.payload)
+
+    def test_loaded_keys_are_cached(self):
+        verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+        verified_signatures.clear()  # otherwise the key isn't even looked up again
+        verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+
+        assert public_keys.get(example_keys.C1_pub) is True
+        assert public_keys.hits == 2
+
+    def test_malformed_key_is_not_loaded_again(self):
+        with pytest.raises(crypto.InvalidKey):
+            verify_many([('not a key', self.signature, self.payload)])
+
+        assert public_keys.get('not a key') is False
+
+        with pytest.raises(crypto.InvalidKey):
+            verify_many([('not a key', self.signature, self.payload)])
+
+    def test_deleting_user_invalidates_key(self):
+        group = Group.objects.create(name='test', key=example_keys.G1_pub)
+        user = User.objects.create(group=group, key=example_keys.C1_pub)
+        verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+
+        user.delete()
+
+        assert public_keys.get(example_keys.C1_pub) is None
+
+
+class VerifiedSignatureCacheTests(TestCase):
+    def setUp(self):
+        verified_signatures.clear()
+        self.payload = json.dumps({'user': example_keys.C1_pub})
+        self.signature = crypto.sign(example_keys.C1_priv, self.payload)
+
+    def test_replayed_signature_is_not_verified_again(self):
+        verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+
+        verified = []
+        original_verify = crypto.verify
+        crypto.verify = lambda *triple: verified.append(triple)
+        try:
+            verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+        finally:
+            crypto.verify = original_verify
+
+        assert verified == []
+        assert verified_signatures.hits == 1
+
+    def test_verified_signature_expires(self):
+        now = [0]
+        verified_signatures.clock = lambda: now[0]
+        try:
+            verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+            assert len(verified_signatures) == 1
+
+            now[0] = settings.VERIFIED_SIGNATURE_CACHE['TTL'] + 1
+            verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+        finally:
+            verified_signatures.clock = time.monotonic
+
+        assert verified_signatures.hits == 0
+        assert verified_signatures.misses == 2
+
+    def test_least_recently_verified_signature_is_evicted(self):
+        other_payload = json.dumps({'user': example_keys.C2_pub})
+        other = (example_keys.C1_pub, crypto.sign(example_keys.C1_priv, other_payload),
+                 other_payload)
+        max_size, verified_signatures.max_size = verified_signatures.max_size, 1
+        try:
+            verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+            verify_many([other])
+            assert len(verified_signatures) == 1
+
+            verify_many([other])
+            verify_many([(example_keys.C1_pub, self.signature, self.payload)])
+        finally:
+            verified_signatures.max_size = max_size
+
+        # only the most recent one was still remembered
+        assert verified_signatures.hits == 1
+
+    def test_invalid_signature_is_not_remembered(self):
+        signature = crypto.sign(example_keys.C2_priv, self.payload)
+
+        for _ in range(2):
+            with pytest.raises(crypto.InvalidSignature):
+                verify_many([(example_keys.C1_pub, signature, self.payload)])
+
+        assert len(verified_signatures) == 0
+
+
+class SignResponseMiddlewareTests(TestCase):
+    def setUp(self):
+        _, self.server_key = crypto.load_keys('server_keys.pem')
+
+    def test_rest_responses_are_signed(self):
+        response = self.client.post(reverse('rest:group:register'), {})
+
+        assert response.status_code == 400
+        assert response['author'] == self.server_key
+        crypto.verify(self.server_key, response['signature'], response.content.decode())
+
+    def test_other_responses_are_not_signed(self):
+        response = self.client.get('/admin/login/')
+
+        assert response.status_code == 200
+        assert not response.has_header('signature')
+
+    @override_settings(RESPONSE_SIGNING_POOL='process', RESPONSE_SIGNING_WORKERS=1)
+    def test_sign_in_process_pool(self):
+        middleware = SignResponseMiddleware(lambda request: HttpResponse('{"value": 1}'))
+        assert middleware.executor is not None
+        try:
+            response = middleware(RequestFactory().post('/rest/uome/get-totals/'))
+        finally:
+            middleware.executor.shutdown()
+
+        assert response['author'] == self.server_key
+        crypto.verify(self.server_key, response['signature'], response.content.decode())
+
+
+@override_settings(REPLICA_DATABASE='replica')
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        routers.recent_writers.clear()
+        self.router = routers.ReplicaRouter()
+        self.factory = RequestFactory()
+
+        @read_from_replica
+        def read_view(request):
+            return HttpResponse(self.router.db_for_read(User))
+
+        @pin_author_to_primary
+        def write_view(request):
+            return HttpResponse(self.router.db_for_write(User))
+
+        self.read_view, self.write_view = read_view, write_view
+
+    def test_reads_go_to_replica_only_inside_read_only_views(self):
+        assert self.router.db_for_read(User) is None
+
+        response = self.read_view(self.factory.post('/', {'author': 'user'}))
+
+        assert response.content.decode() == 'replica'
+        assert self.router.db_for_read(User) is None
+
+    def test_author_reads_own_writes_from_primary(self):
+        self.write_view(self.factory.post('/', {'author': 'user'}))
+
+        response = self.read_view(self.factory.post('/', {'author': 'user'}))
+        assert response.content.decode() == 'None'
+
+        response = self.read_view(self.factory.post('/', {'author': 'other user'}))
+        assert response.content.decode() == 'replica'
+
+    def test_replica_is_not_migrated(self):
+        assert not self.router.allow_migrate('replica', 'rest_app')
+        assert self.router.allow_migrate('default', 'rest_app')
+
+
+class TotalsCacheTests(TestCase):
+    def setUp(self):
+        self.totals_cache = TotalsCache(LRUCache(10))
+
+    def test_entry_is_stored_under_current_version(self):
+        totals, version = self.totals_cache.get('group')
+        assert totals is None
+
+        self.totals_cache.set('group', version, {'balances': {}})
+
+        assert self.totals_cache.get('group') == ({'balances': {}}, version)
+
+    def test_entry_built_before_invalidation_is_never_read(self):
+        _, version = self.totals_cache.get('group')
+        self.totals_cache.invalidate('group')
+        self.totals_cache.set('group', version, {'balances': {}})
+
+        totals, new_version = self.totals_cache.get('group')
+        assert totals is None
+        assert new_version != version
+
+
+class NotificationsTests(TestCase):
+    def setUp(self):
+        self.notifications = Notifications()
+
+    def test_wait_times_out_without_a_publish(self):
+        since = self.notifications.current('group', 'user')
+        assert not self.notifications.wait('group', 'user', since, timeout=0.01)
+
+    def test_publish_before_wait_is_not_missed(self):
+        since = self.notifications.current('group', 'user')
+        self.notifications.publish('group', ['user'])
+
+        assert self.notifications.wait('group', 'user', since, timeout=0)
+
+    def test_publish_to_other_user_does_not_wake_up(self):
+        since = self.notifications.current('group', 'user')
+        self.notifications.publish('group', ['other user'])
+        self.notifications.publish('other group', ['user'])
+
+        assert not self.notifications.wait('group', 'user', since, timeout=0.01)
+
+    def test_publish_from_other_thread_wakes_up_waiter(self):
+        since = self.notifications.current('group', 'user')
+        publisher = threading.Timer(0.05, self.notifications.publish, ['group', ['user']])
+        publisher.start()
+
+        try:
+            assert self.notifications.wait('group', 'user', since, timeout=5)
+        finally:
+            publisher.join()
+
+    def test_wait_is_refused_at_max_waiters(self):
+        self.notifications.max_waiters = 1
+        waiter = threading.Thread(target=self.notifications.wait,
+                                  args=['group', 'user', 0, 5])
+        waiter.start()
+        try:
+            while self.notifications.waiters < 1:
+                time.sleep(0.001)
+
+            with pytest.raises(TooManyWaiters):
+                self.notifications.wait('group', 'other user', 0, timeout=0)
+        finally:
+            self.notifications.publish('group', ['user'])
+            waiter.join()
+
+        assert self.notifications.waiters == 0
+
+
+def run_asgi(scope, messages) -> list:
+    """
+    Runs the ASGI application with a scope and the messages it receives, in a new
+    event loop. Returns the messages it sent
+    """
+    from global_server.asgi import application
+
+    messages = list(messages)
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(application(scope, receive, send))
+    finally:
+        loop.close()
+
+    return sent
+
+
+class AsgiApplicationTests(TestCase):
+    def test_request_is_answered_by_the_views(self):
+        sent = run_asgi({'type': 'http', 'http_version': '1.1', 'method': 'POST',
+                         'path': reverse('rest:uome:get-totals'), 'query_string': b'',
+                         'headers': []},
+                        [{'type': 'http.request', 'body': b''}])
+
+        # the request is not signed
+        assert sent[0]['type'] == 'http.response.start'
+        assert sent[0]['status'] == 400
+
+    def test_lifespan(self):
+        sent = run_asgi({'type': 'lifespan'},
+                        [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+
+        assert [message['type'] for message in sent] == ['lifespan.startup.complete',
+                                                         'lifespan.shutdown.complete']
+
+
+class TimingTests(TestCase):
+    def test_nested_phases_do_not_overlap(self):
+        timing.start()
+        with timing.phase('outer'):
+            with timing.phase('inner'):
+                time.sleep(0.02)
+        phases = timing.stop()
+
+        assert phases['inner'] >= 0.02
+        assert phases['outer'] < 0.02
+
+    def test_phases_are_ignored_when_not_timing(self):
+        with timing.phase('phase'):
+            pass
+
+        assert timing.stop() == {}
+
+
+@override_settings(SERVER_TIMING=True)
+class ServerTimingMiddlewareTests(TestCase):
+    def test_server_timing_header(self):
+        verified_signatures.clear()  # so that the envelope is actually verified
+        private_key, key = example_keys.G1_priv, example_keys.G1_pub
+        payload = json.dumps({'group_name': 'test', 'group_key': key})
+
+        response = self.client.post(reverse('rest:group:register'),
+                                    {'author': key,
+                                     'signature': crypto.sign(private_key, payload),
+                                     'payload': payload})
+
+        assert response.status_code == 201
+        durations = dict(metric.split(';dur=')
+                         for metric in response['Server-Timing'].split(', '))
+        assert list(durations)[-2:] == ['db', 'total']
+        assert 'sign' in durations
+        assert float(durations['verify_author']) > 0
+
+    @override_settings(SERVER_TIMING=False)
+    def test_no_header_when_off(self):
+        response = self.client.post(reverse('rest:group:register'), {})
+
+        assert not response.has_header('Server-Timing')
+
+
+@override_settings(METRICS=True)
+class MetricsTests(TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('latency', 'Latency', (0.1, 1), ('view',))
+        histogram.observe(0.05, 'view')
+        histogram.observe(0.5, 'view')
+        histogram.observe(5, 'view')
+
+        assert histogram.expose() == ['# HELP latency Latency',
+                                      '# TYPE latency histogram',
+                                      'latency_bucket{view="view",le="0.1"} 1',
+                                      'latency_bucket{view="view",le="1"} 2',
+                                      'latency_bucket{view="view",le="+Inf"} 3',
+                                      'latency_sum{view="view"} 5.55',
+                                      'latency_count{view="view"} 3']
+
+    def test_counter_from_many_threads(self):
+        counter = metrics.Counter('requests', 'Requests', ('view',))
+
+        def count():
+            for _ in range(1000):
+                counter.inc('view')
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert counter.value('view') == 4000
+
+    def test_requests_are_recorded_by_view(self):
+        private_key, key = example_keys.G1_priv, example_keys.G1_pub
+        payload = json.dumps({'group_name': 'test', 'group_key': key})
+        requests = metrics.requests.value('rest:group:register', 201)
+        verifications = metrics.signature_verifications.value('rest:group:register')
+
+        self.client.post(reverse('rest:group:register'),
+                         {'author': key,
+                          'signature': crypto.sign(private_key, payload),
+                          'payload': payload})
+
+        assert metrics.requests.value('rest:group:register', 201) == requests + 1
+        # unless the same envelope was verified recently
+        assert metrics.signature_verifications.value('rest:group:register') <= \
+            verifications + 1
+        assert metrics.db_queries.value('rest:group:register') >= 1
+
+    @override_settings(METRICS=False)
+    def test_requests_are_not_recorded_when_off(self):
+        requests = metrics.requests.value('metrics', 403)
+
+        self.client.get(reverse('metrics'))
+
+        assert metrics.requests.value('metrics', 403) == requests
+        assert not connection.force_debug_cursor
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_endpoint_requires_token(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        assert response.status_code == 200
+        assert b'# TYPE groupbank_requests_total counter' in response.content
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer other')
+        assert response.status_code == 403
+
+        # not even from the address of a local proxy
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1')
+        assert response.status_code == 403
+
+    @override_settings(METRICS_TOKEN='')
+    def test_endpoint_is_closed_without_token(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ')
+        assert response.status_code == 403
+
+
+@query_budget(1)
+def view_with_two_queries(request):
+    list(Group.objects.all())
+    list(User.objects.all())
+    return HttpResponse()
+
+
+@query_budget(2)
+def view_with_two_queries_in_budget(request):
+    return view_with_two_queries.__wrapped__(request)
+
+
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().post('/')
+
+    def test_within_budget(self):
+        assert view_with_two_queries_in_budget(self.request).status_code == 200
+
+    def test_over_budget_fails_while_testing(self):
+        with self.assertLogs('rest_app.decorators', 'WARNING') as logs:
+            with pytest.raises(QueryBudgetExceeded):
+                view_with_two_queries(self.request)
+
+        assert 'list(User.objects.all())' in logs.output[0]  # the line that made it
+
+    @override_settings(QUERY_BUDGET_STRICT=False)
+    def test_over_budget_logs_queries_without_stack_trace(self):
+        with self.assertLogs('rest_app.decorators', 'WARNING') as logs:
+            response = view_with_two_queries(self.request)
+
+        assert response.status_code == 200
+        assert 'rest_app_user' in logs.output[0]
+        assert 'list(User.objects.all())' not in logs.output[0]
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'only SQLite connections are set up')
+    def test_connection_setup_is_not_counted(self):
+        @query_budget(2)
+        def view_opening_connection(request):
+            # what opening a new connection does, the test database is never closed
+            connection_created.send(sender=connection.__class__, connection=connection)
+            return view_with_two_queries.__wrapped__(request)
+
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            cache_size = cursor.fetchone()[0]
+            try:
+                with override_settings(SQLITE_PRAGMAS={'cache_size': -1024}):
+                    assert view_opening_connection(self.request).status_code == 200
+
+                cursor.execute('PRAGMA cache_size')
+                assert cursor.fetchone()[0] == -1024
+            finally:
+                cursor.execute('PRAGMA cache_size = %d' % cache_size)
+
+    @override_settings(QUERY_BUDGETS=False)
+    def test_off_budgets_do_not_log_queries(self):
+        connection.queries_log.clear()
+        assert view_with_two_queries(self.request).status_code == 200
+        assert not connection.force_debug_cursor
+        assert len(connection.queries_log) == 0
@@ -0,0 +1,47 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_state = threading.local()
+
+
+def start() -> None:
+    """
+    Starts timing the phases of the current request in this thread
+    """
+    _state.phases = OrderedDict()
+    _state.stack = []
+
+
+def stop() -> OrderedDict:
+    """
+    Stops timing and returns the seconds spent in each phase
+    """
+    phases = getattr(_state, 'phases', None)
+    _state.phases = None
+    return phases or OrderedDict()
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Adds the time spent inside the block to a phase of the current request. The time
+    of a phase nested in another one only counts for the inner phase, so the phases
+    never overlap. Does nothing when the request is not being timed
+    """
+    phases = getattr(_state, 'phases', None)
+    if phases is None:
+        yield
+        return
+
+    frame = [time.perf_counter(), 0]  # start, seconds spent in nested phases
+    _state.stack.append(frame)
+    try:
+        yield
+    finally:
+        _state.stack.pop()
+        elapsed = time.perf_counter() - frame[0]
+        phases[name] = phases.get(name, 0) + elapsed - frame[1]
+        if _state.stack:
+            _state.stack[-1][1] += elapsed
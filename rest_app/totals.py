@@ -0,0 +1,83 @@
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from rest_app.utils.cache import LRUCache
+
+
+class TotalsCache(object):
+    """
+    Cache of the balances and the simplified debt of each group, from which get-totals
+    answers without touching the database.
+
+    The entry of a group is stored under the current version of the group, a random
+    token that changes every time the group is invalidated. An entry built from data
+    read before an invalidation is stored under the old version and never read again,
+    even if it's stored after the invalidation. The backend is anything with the get()
+    and set() of a Django cache, e.g. an LRUCache
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, group_uuid: str) -> (dict, str):
+        """
+        Returns the entry of the group, or None, and the version to store a new one with
+        """
+        version = self.backend.get('totals-version:%s' % group_uuid)
+        if version is None:
+            version = self._new_version(group_uuid)
+
+        return self.backend.get('totals:%s:%s' % (group_uuid, version)), version
+
+    def set(self, group_uuid: str, version: str, totals: dict) -> None:
+        self.backend.set('totals:%s:%s' % (group_uuid, version), totals)
+
+    def invalidate(self, group_uuid: str) -> None:
+        """
+        Invalidates the entry of the group now, and again when the current transaction
+        commits, so that no other thread reads uncommitted changes into a new entry
+        """
+        self._new_version(group_uuid)
+        transaction.on_commit(lambda: self._new_version(group_uuid))
+
+    def _new_version(self, group_uuid: str) -> str:
+        version = uuid.uuid4().hex
+        self.backend.set('totals-version:%s' % group_uuid, version)
+        return version
+
+
+def load_totals(group_uuid: str) -> dict:
+    """
+    Reads the version, the balances and the simplified debt of a group, like
+    {'version': 3, 'balances': {user: balance}, 'debts': {borrower: {lender: value}},
+     'credits': {lender: {borrower: value}}}
+    Always reads from the primary database, a lagging replica would be cached
+    """
+    from rest_app.models import User, UserDebt
+
+    balances = {}
+    version = None
+    # the version is read before the debts, so it's never newer than them
+    for key, balance, version in User.objects.using(DEFAULT_DB_ALIAS).filter(
+            group_id=group_uuid).values_list('key', 'balance', 'group__version'):
+        balances[key] = balance
+
+    debts = defaultdict(dict)
+    credits = defaultdict(dict)
+    for borrower, lender, value in UserDebt.objects.using(DEFAULT_DB_ALIAS).filter(
+            group_id=group_uuid).values_list('borrower_id', 'lender_id', 'value'):
+        debts[borrower][lender] = value
+        credits[lender][borrower] = value
+
+    return {'version': version, 'balances': balances, 'debts': dict(debts),
+            'credits': dict(credits)}
+
+
+if settings.TOTALS_CACHE['BACKEND'] is None:
+    totals_cache = TotalsCache(LRUCache(settings.TOTALS_CACHE['MAX_SIZE']))
+else:
+    totals_cache = TotalsCache(caches[settings.TOTALS_CACHE['BACKEND']])
@@ -1,12 +1,19 @@
 import json
+import threading
+import time
 
 from collections import defaultdict
-from django.test import TestCase
+from django.db import connection
+from django.test import (Client, TestCase, TransactionTestCase, override_settings,
+                         skipUnlessDBFeature)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 import groupbank_crypto.ec_secp256k1 as crypto
-from rest_app import example_keys
+from rest_app import example_keys, routers, signatures
 from rest_app.models import Group, User, UOMe, UserDebt
+from rest_app.notifications import pending_notifications
+from rest_app.uome.views import _update_group_debt
 
 _, server_key = crypto.load_keys('server_keys.pem')
 
@@ -63,6 +70,151 @@ class IssueUOMeTests(TestCase):
         assert uome.issuer_signature == ''
 
 
+class IssueBatchTests(TestCase):
+    def setUp(self):
+        self.private_key, self.key = example_keys.C1_priv, example_keys.C1_pub
+        self.group = Group.objects.create(name='test', key=example_keys.G1_pub)
+        self.user = User.objects.create(group=self.group, key=self.key)
+        self.borrower1 = User.objects.create(group=self.group, key=example_keys.C2_pub)
+        self.borrower2 = User.objects.create(group=self.group, key=example_keys.C3_pub)
+
+        auth_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                   'user': self.user.key})
+        self.auth_signature = crypto.sign(self.private_key, auth_payload)
+
+    def issue_batch(self, uomes):
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'user_signature': self.auth_signature,
+                              'uomes': uomes})
+        signature = crypto.sign(self.private_key, payload)
+
+        return self.client.post(reverse('rest:uome:issue-batch'),
+                                {'author': self.user.key,
+                                 'signature': signature,
+                                 'payload': payload})
+
+    def test_split_expense(self):
+        response = self.issue_batch([
+            {'borrower': self.borrower1.key, 'value': 500, 'description': 'dinner'},
+            {'borrower': self.borrower2.key, 'value': 700, 'description': 'dinner'},
+        ])
+
+        assert response.status_code == 201
+        assert response['author'] == server_key
+        crypto.verify(server_key, response['signature'], response.content.decode())
+
+        payload = json.loads(response.content.decode())
+
+        assert payload['group_uuid'] == str(self.group.uuid)
+        assert payload['user'] == self.user.key
+        assert [(uome['borrower'], uome['value']) for uome in payload['uomes']] == \
+            [(self.borrower1.key, 500), (self.borrower2.key, 700)]
+
+        for issued in payload['uomes']:
+            uome = UOMe.objects.get(pk=issued['uome_uuid'])
+            assert uome.lender == self.user
+            assert uome.borrower.key == issued['borrower']
+            assert uome.description == 'dinner'
+            assert uome.state == UOMe.ISSUED
+
+    def test_unknown_borrower_issues_nothing(self):
+        response = self.issue_batch([
+            {'borrower': self.borrower1.key, 'value': 500, 'description': 'dinner'},
+            {'borrower': example_keys.C4_pub, 'value': 700, 'description': 'dinner'},
+        ])
+
+        assert response.status_code == 400
+        assert not UOMe.objects.exists()
+
+    def test_confirm_batch(self):
+        uomes = [UOMe.objects.create(group=self.group, lender=self.user, borrower=borrower,
+                                     value=10, description='test')
+                 for borrower in (self.borrower1, self.borrower2)]
+
+        signatures = [crypto.sign(self.private_key, json.dumps({
+            'group_uuid': str(self.group.uuid),
+            'user': self.user.key,
+            'borrower': uome.borrower.key,
+            'value': 10,
+            'description': 'test',
+            'uome_uuid': str(uome.uuid),
+        })) for uome in uomes]
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'uomes': [
+                                  {'uome_uuid': str(uomes[0].uuid),
+                                   'user_signature': signatures[0]},
+                                  {'uome_uuid': str(uomes[1].uuid),
+                                   'user_signature': signatures[0]},
+                              ]})
+        signature = crypto.sign(self.private_key, payload)
+
+        response = self.client.post(reverse('rest:uome:confirm-batch'),
+                                    {'author': self.user.key,
+                                     'signature': signature,
+                                     'payload': payload})
+
+        assert response.status_code == 200
+        assert response['author'] == server_key
+        crypto.verify(server_key, response['signature'], response.content.decode())
+
+        payload = json.loads(response.content.decode())
+        assert payload['results'] == [
+            {'uome_uuid': str(uomes[0].uuid), 'confirmed': True},
+            {'uome_uuid': str(uomes[1].uuid), 'confirmed': False,
+             'error': 'invalid signature'},
+        ]
+
+        uome = UOMe.objects.get(pk=uomes[0].uuid)
+        assert uome.issuer_signature == signatures[0]
+        assert uome.state == UOMe.CONFIRMED
+        assert UOMe.objects.get(pk=uomes[1].uuid).state == UOMe.ISSUED
+
+    def test_confirm_batch_leaves_uomes_accepted_meanwhile(self):
+        uomes = [UOMe.objects.create(group=self.group, lender=self.user, borrower=borrower,
+                                     value=10, description='test')
+                 for borrower in (self.borrower1, self.borrower2)]
+        entries = [{'uome_uuid': str(uome.uuid),
+                    'user_signature': crypto.sign(self.private_key, json.dumps({
+                        'group_uuid': str(self.group.uuid),
+                        'user': self.user.key,
+                        'borrower': uome.borrower.key,
+                        'value': 10,
+                        'description': 'test',
+                        'uome_uuid': str(uome.uuid),
+                    }))} for uome in uomes]
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'uomes': entries})
+
+        # a concurrent accept of the second uome, after confirm-batch read it as issued
+        check_many = signatures.check_many
+
+        def accept_meanwhile(triples):
+            UOMe.objects.filter(pk=uomes[1].pk).update(state=UOMe.ACCEPTED)
+            return check_many(triples)
+
+        signatures.check_many = accept_meanwhile
+        try:
+            response = self.client.post(reverse('rest:uome:confirm-batch'),
+                                        {'author': self.user.key,
+                                         'signature': crypto.sign(self.private_key, payload),
+                                         'payload': payload})
+        finally:
+            signatures.check_many = check_many
+
+        assert response.status_code == 200
+        assert json.loads(response.content.decode())['results'] == [
+            {'uome_uuid': str(uomes[0].uuid), 'confirmed': True},
+            {'uome_uuid': str(uomes[1].uuid), 'confirmed': False,
+             'error': 'already confirmed'},
+        ]
+        assert UOMe.objects.get(pk=uomes[0].pk).state == UOMe.CONFIRMED
+        assert UOMe.objects.get(pk=uomes[1].pk).state == UOMe.ACCEPTED
+
+
 class ConfirmUOMeTests(TestCase):
     def setUp(self):
         self.private_key, self.key = example_keys.C1_priv, example_keys.C1_pub
@@ -253,6 +405,253 @@ class GetPendingUOMesTests(TestCase):
             assert uome['uuid'] == str(uome_for_user.uuid)
             assert uome['issuer_signature'] == uome_for_user_signature
 
+    def test_only_confirmed_uomes_are_pending(self):
+        issued = UOMe.objects.create(group=self.group, lender=self.user,
+                                     borrower=self.other_user, value=10,
+                                     description='issued')
+        confirmed = UOMe.objects.create(group=self.group, lender=self.user,
+                                        borrower=self.other_user, value=20,
+                                        description='confirmed', issuer_signature='meh')
+        accepted = UOMe.objects.create(group=self.group, lender=self.user,
+                                       borrower=self.other_user, value=30,
+                                       description='accepted', issuer_signature='meh',
+                                       borrower_signature='meh')
+
+        assert (issued.state, confirmed.state, accepted.state) == \
+            (UOMe.ISSUED, UOMe.CONFIRMED, UOMe.ACCEPTED)
+
+        auth_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                   'user': self.user.key})
+        auth_signature = crypto.sign(self.private_key, auth_payload)
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'user_signature': auth_signature})
+        signature = crypto.sign(self.private_key, payload)
+
+        response = self.client.post(reverse('rest:uome:get-pending'),
+                                    {'author': self.user.key,
+                                     'signature': signature,
+                                     'payload': payload})
+
+        assert response.status_code == 200
+
+        payload = json.loads(response.content.decode())
+        issued_by_user = json.loads(payload['issued_by_user'])
+        assert [uome['uuid'] for uome in issued_by_user] == [str(confirmed.uuid)]
+        assert json.loads(payload['waiting_for_user']) == []
+
+    def test_not_modified_when_version_is_current(self):
+        auth_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                   'user': self.user.key})
+        auth_signature = crypto.sign(self.private_key, auth_payload)
+
+        def get_pending(version):
+            payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                  'user': self.user.key,
+                                  'user_signature': auth_signature,
+                                  'version': version})
+            signature = crypto.sign(self.private_key, payload)
+
+            response = self.client.post(reverse('rest:uome:get-pending'),
+                                        {'author': self.user.key,
+                                         'signature': signature,
+                                         'payload': payload})
+            assert response.status_code == 200
+            assert response['author'] == server_key
+            crypto.verify(server_key, response['signature'], response.content.decode())
+            return json.loads(response.content.decode())
+
+        version = get_pending(None)['version']
+
+        with self.assertNumQueries(1):
+            payload = get_pending(version)
+
+        assert payload == {'group_uuid': str(self.group.uuid),
+                           'user': self.user.key,
+                           'version': version,
+                           'not_modified': True}
+
+        # issuing a uome changes the version
+        issue_auth_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                         'user': self.other_user.key})
+        issue_payload = json.dumps({
+            'group_uuid': str(self.group.uuid),
+            'user': self.other_user.key,
+            'borrower': self.user.key,
+            'value': 10,
+            'description': 'test',
+            'user_signature': crypto.sign(example_keys.C2_priv, issue_auth_payload)})
+        response = self.client.post(reverse('rest:uome:issue'),
+                                    {'author': self.other_user.key,
+                                     'signature': crypto.sign(example_keys.C2_priv,
+                                                              issue_payload),
+                                     'payload': issue_payload})
+        assert response.status_code == 201
+
+        payload = get_pending(version)
+
+        assert 'not_modified' not in payload
+        assert payload['version'] > version
+
+    @override_settings(REPLICA_DATABASE='default')  # the "replica" is the test database
+    def test_version_ahead_of_replica_reads_from_primary(self):
+        auth_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                   'user': self.user.key})
+        # what a lagging replica answers to a user that got a newer version elsewhere
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'user_signature': crypto.sign(self.private_key, auth_payload),
+                              'version': self.group.version + 1})
+
+        reads = []
+        db_for_read = routers.ReplicaRouter.db_for_read
+        routers.ReplicaRouter.db_for_read = lambda router, model, **hints: \
+            reads.append((model, db_for_read(router, model, **hints))) or reads[-1][1]
+        try:
+            response = self.client.post(reverse('rest:uome:get-pending'),
+                                        {'author': self.user.key,
+                                         'signature': crypto.sign(self.private_key, payload),
+                                         'payload': payload})
+        finally:
+            routers.ReplicaRouter.db_for_read = db_for_read
+
+        assert response.status_code == 200
+        assert 'not_modified' not in json.loads(response.content.decode())
+        # the user from the replica, then the user and the lists from the primary
+        assert reads == [(User, 'default'), (User, None), (UOMe, None), (UOMe, None)]
+
+    def test_query_count_does_not_depend_on_number_of_uomes(self):
+        auth_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                   'user': self.user.key})
+        auth_signature = crypto.sign(self.private_key, auth_payload)
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'user_signature': auth_signature})
+        signature = crypto.sign(self.private_key, payload)
+
+        for uome_count in (1, 20):
+            for _ in range(uome_count):
+                UOMe.objects.create(group=self.group, lender=self.user,
+                                    borrower=self.other_user, value=10,
+                                    description='by user', issuer_signature='meh')
+                UOMe.objects.create(group=self.group, lender=self.other_user,
+                                    borrower=self.user, value=10,
+                                    description='for user', issuer_signature='meh')
+
+            # the user with its group and one query for each list
+            with self.assertNumQueries(3):
+                response = self.client.post(reverse('rest:uome:get-pending'),
+                                            {'author': self.user.key,
+                                             'signature': signature,
+                                             'payload': payload})
+
+            assert response.status_code == 200
+
+
+class WaitPendingTests(TestCase):
+    def setUp(self):
+        self.private_key, self.key = example_keys.C1_priv, example_keys.C1_pub
+        self.group = Group.objects.create(name='test', key=example_keys.G1_pub)
+        self.user = User.objects.create(group=self.group, key=self.key)
+
+    def wait_pending(self, **extra):
+        auth_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                   'user': self.user.key})
+        payload = json.dumps(dict({'group_uuid': str(self.group.uuid),
+                                   'user': self.user.key,
+                                   'user_signature': crypto.sign(self.private_key,
+                                                                 auth_payload),
+                                   }, **extra))
+
+        return self.client.post(reverse('rest:uome:wait-pending'),
+                                {'author': self.user.key,
+                                 'signature': crypto.sign(self.private_key, payload),
+                                 'payload': payload})
+
+    def test_nothing_new_until_timeout(self):
+        response = self.wait_pending(timeout=0)
+
+        assert response.status_code == 200
+        assert json.loads(response.content.decode())['changed'] is False
+
+    def test_outdated_version_answers_immediately(self):
+        response = self.wait_pending(version=self.group.version + 1, timeout=30)
+
+        assert response.status_code == 200
+        assert json.loads(response.content.decode())['changed'] is True
+
+    def test_negative_timeout(self):
+        response = self.wait_pending(timeout=-1)
+
+        assert response.status_code == 400
+
+
+class WaitPendingLimitTests(TransactionTestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='test', key=example_keys.G1_pub)
+        self.users = [(private_key, User.objects.create(group=self.group, key=key))
+                      for private_key, key in [(example_keys.C1_priv, example_keys.C1_pub),
+                                               (example_keys.C2_priv, example_keys.C2_pub),
+                                               (example_keys.C3_priv, example_keys.C3_pub)]]
+
+        self.max_waiters = pending_notifications.max_waiters
+        pending_notifications.max_waiters = 2
+
+    def tearDown(self):
+        pending_notifications.max_waiters = self.max_waiters
+
+    def post(self, client, url_name, private_key, user, **extra):
+        auth_payload = json.dumps({'group_uuid': str(self.group.uuid), 'user': user.key})
+        payload = json.dumps(dict({'group_uuid': str(self.group.uuid),
+                                   'user': user.key,
+                                   'user_signature': crypto.sign(private_key, auth_payload),
+                                   }, **extra))
+
+        return client.post(reverse(url_name),
+                           {'author': user.key,
+                            'signature': crypto.sign(private_key, payload),
+                            'payload': payload})
+
+    def test_other_requests_are_served_while_waiters_are_blocked(self):
+        responses = []
+
+        def wait(private_key, user):
+            try:
+                responses.append(self.post(Client(), 'rest:uome:wait-pending', private_key,
+                                           user, timeout=10))
+            finally:
+                connection.close()
+
+        waiters = [threading.Thread(target=wait, args=self.users[i]) for i in range(2)]
+        for waiter in waiters:
+            waiter.start()
+
+        try:
+            while pending_notifications.waiters < 2:
+                time.sleep(0.001)
+
+            # a third waiter doesn't take another thread
+            response = self.post(self.client, 'rest:uome:wait-pending', *self.users[2],
+                                 timeout=10)
+            assert response.status_code == 429
+            assert response['Retry-After'] == '30'
+
+            # and the other requests are served meanwhile
+            response = self.post(self.client, 'rest:uome:get-pending', *self.users[2])
+            assert response.status_code == 200
+            assert pending_notifications.waiters == 2
+        finally:
+            pending_notifications.publish(str(self.group.uuid),
+                                          [user.key for _, user in self.users])
+            for waiter in waiters:
+                waiter.join()
+
+        assert [response.status_code for response in responses] == [200, 200]
+        assert all(json.loads(response.content.decode())['changed']
+                   for response in responses)
+
 
 class AcceptTests(TestCase):
     def setUp(self):
@@ -331,6 +730,416 @@ class AcceptTests(TestCase):
 
         assert simplified_debt == {self.user: {self.lender: uome.value}}
 
+    def test_accept_keeps_unchanged_debt(self):
+        other_user = User.objects.create(group=self.group, key=example_keys.C3_pub,
+                                         balance=-100)
+        self.lender.balance = 100
+        self.lender.save()
+        other_debt = UserDebt.objects.create(group=self.group, borrower=other_user,
+                                             lender=self.lender, value=100)
+
+        uome = UOMe.objects.create(group=self.group, lender=self.lender,
+                                   borrower=self.user, value=10, description='test',
+                                   issuer_signature='meh')
+
+        borrower_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                       'issuer': self.lender.key,
+                                       'borrower': self.user.key,
+                                       'value': 10,
+                                       'description': 'test',
+                                       'uome_uuid': str(uome.uuid),
+                                       })
+        borrower_signature = crypto.sign(self.private_key, borrower_payload)
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'uome_uuid': str(uome.uuid),
+                              'user_signature': borrower_signature,
+                              })
+        signature = crypto.sign(self.private_key, payload)
+
+        response = self.client.post(reverse('rest:uome:accept'),
+                                    {'author': self.user.key,
+                                     'signature': signature,
+                                     'payload': payload})
+
+        assert response.status_code == 200
+
+        totals = {user: user.balance for user in User.objects.filter(group=self.group)}
+        assert totals == {self.user: -10, self.lender: 110, other_user: -100}
+
+        # the debt of the user that was not involved was left untouched
+        assert UserDebt.objects.get(borrower=other_user) == other_debt
+        assert UserDebt.objects.get(borrower=other_user).value == 100
+        assert UserDebt.objects.get(borrower=self.user, lender=self.lender).value == 10
+
+
+def signed_accept(private_key, uome) -> dict:
+    """
+    The POST data of an accept request for a uome, signed by its borrower
+    """
+    borrower_payload = json.dumps({'group_uuid': str(uome.group_id),
+                                   'issuer': uome.lender_id,
+                                   'borrower': uome.borrower_id,
+                                   'value': uome.value,
+                                   'description': uome.description,
+                                   'uome_uuid': str(uome.uuid),
+                                   })
+    payload = json.dumps({'group_uuid': str(uome.group_id),
+                          'user': uome.borrower_id,
+                          'uome_uuid': str(uome.uuid),
+                          'user_signature': crypto.sign(private_key, borrower_payload),
+                          })
+
+    return {'author': uome.borrower_id,
+            'signature': crypto.sign(private_key, payload),
+            'payload': payload}
+
+
+class AcceptTwiceTests(TestCase):
+    def test_uome_is_only_counted_once(self):
+        group = Group.objects.create(name='test', key=example_keys.G1_pub)
+        borrower = User.objects.create(group=group, key=example_keys.C1_pub)
+        lender = User.objects.create(group=group, key=example_keys.C2_pub)
+        uome = UOMe.objects.create(group=group, lender=lender, borrower=borrower,
+                                   value=10, description='test', issuer_signature='meh')
+
+        data = signed_accept(example_keys.C1_priv, uome)
+
+        assert self.client.post(reverse('rest:uome:accept'), data).status_code == 200
+        assert self.client.post(reverse('rest:uome:accept'), data).status_code == 400
+
+        assert User.objects.get(key=borrower.key).balance == -10
+
+
+# SQLite ignores row locks and serializes all the writes of the database instead
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentAcceptTests(TransactionTestCase):
+    UOMES_PER_BORROWER = 15
+
+    def test_balances_add_up_with_concurrent_accepts(self):
+        groups = [Group.objects.create(name='test1', key=example_keys.G1_pub),
+                  Group.objects.create(name='test2', key=example_keys.G2_pub)]
+        borrower_keys = [(groups[0], example_keys.C1_priv, example_keys.C1_pub),
+                         (groups[0], example_keys.C2_priv, example_keys.C2_pub),
+                         (groups[1], example_keys.C3_priv, example_keys.C3_pub),
+                         (groups[1], example_keys.C4_priv, example_keys.C4_pub)]
+
+        lenders = {group: [User.objects.create(group=group, key='%s-%d' % (group.uuid, i))
+                           for i in range(3)]
+                   for group in groups}
+
+        requests = []  # the accept requests of each borrower
+        for group, private_key, key in borrower_keys:
+            borrower = User.objects.create(group=group, key=key)
+            uomes = [UOMe.objects.create(group=group, borrower=borrower,
+                                         lender=lenders[group][i % 3], value=i + 1,
+                                         description='test', issuer_signature='meh')
+                     for i in range(self.UOMES_PER_BORROWER)]
+            requests.append([signed_accept(private_key, uome) for uome in uomes])
+
+        errors = []
+
+        def accept_all(borrower_requests):
+            client = Client()
+            try:
+                for data in borrower_requests:
+                    response = client.post(reverse('rest:uome:accept'), data)
+                    if response.status_code != 200:
+                        errors.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=accept_all, args=(borrower_requests,))
+                   for borrower_requests in requests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+
+        expected_debt = -sum(range(1, self.UOMES_PER_BORROWER + 1))
+        for group in groups:
+            balances = dict(User.objects.filter(group=group).values_list('key', 'balance'))
+            assert sum(balances.values()) == 0
+
+            for _, _, key in borrower_keys:
+                if key in balances:
+                    assert balances[key] == expected_debt
+
+            # the simplified debt settles exactly the balances
+            settled = defaultdict(int)
+            for borrower, lender, value in UserDebt.objects.filter(group=group).values_list(
+                    'borrower_id', 'lender_id', 'value'):
+                settled[borrower] -= value
+                settled[lender] += value
+            assert {key: balance for key, balance in balances.items() if balance} == \
+                {key: balance for key, balance in settled.items() if balance}
+
+
+class AcceptBatchTests(TestCase):
+    def setUp(self):
+        self.private_key, self.key = example_keys.C1_priv, example_keys.C1_pub
+        self.group = Group.objects.create(name='test', key=example_keys.G1_pub)
+        self.user = User.objects.create(group=self.group, key=self.key)
+        self.lender1 = User.objects.create(group=self.group, key=example_keys.C2_pub)
+        self.lender2 = User.objects.create(group=self.group, key=example_keys.C3_pub)
+
+    def pending_uome(self, lender, value):
+        uome = UOMe.objects.create(group=self.group, lender=lender, borrower=self.user,
+                                   value=value, description='test',
+                                   issuer_signature='meh')
+
+        borrower_payload = json.dumps({'group_uuid': str(self.group.uuid),
+                                       'issuer': lender.key,
+                                       'borrower': self.user.key,
+                                       'value': value,
+                                       'description': 'test',
+                                       'uome_uuid': str(uome.uuid),
+                                       })
+        return uome, crypto.sign(self.private_key, borrower_payload)
+
+    def test_cancelling_uomes_leave_balances_and_debt_unchanged(self):
+        UserDebt.objects.create(group=self.group, borrower=self.user, lender=self.lender1,
+                                value=5)
+        User.objects.filter(pk=self.user.pk).update(balance=-5)
+        User.objects.filter(pk=self.lender1.pk).update(balance=5)
+
+        # what accept-batch does for two uomes that cancel each other out
+        _update_group_debt(self.group, [[self.user.key, self.lender1.key, 10],
+                                        [self.lender1.key, self.user.key, 10]])
+
+        assert list(UserDebt.objects.filter(group=self.group).values_list(
+            'borrower_id', 'lender_id', 'value')) == [(self.user.key, self.lender1.key, 5)]
+        assert User.objects.get(pk=self.user.pk).balance == -5
+
+    def test_all_entry_signatures_are_verified_in_one_call(self):
+        uome1, signature1 = self.pending_uome(self.lender1, 10)
+        uome2, signature2 = self.pending_uome(self.lender2, 20)
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'uomes': [
+                                  {'uome_uuid': str(uome1.uuid), 'user_signature': signature1},
+                                  {'uome_uuid': str(uome2.uuid), 'user_signature': signature2},
+                              ]})
+
+        calls = []
+        check_many = signatures.check_many
+        signatures.check_many = lambda triples: calls.append(list(triples)) or \
+            check_many(triples)
+        try:
+            response = self.client.post(reverse('rest:uome:accept-batch'),
+                                        {'author': self.user.key,
+                                         'signature': crypto.sign(self.private_key, payload),
+                                         'payload': payload})
+        finally:
+            signatures.check_many = check_many
+
+        assert response.status_code == 200
+        assert len(calls) == 1
+        assert len(calls[0]) == 2  # both uomes, the envelope was verified before
+
+    def test_forged_envelope_is_rejected_before_the_entries(self):
+        uome1, signature1 = self.pending_uome(self.lender1, 10)
+        uome2, signature2 = self.pending_uome(self.lender2, 20)
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'uomes': [
+                                  {'uome_uuid': str(uome1.uuid), 'user_signature': signature1},
+                                  {'uome_uuid': str(uome2.uuid), 'user_signature': signature2},
+                              ]})
+
+        forged_signature = crypto.sign(example_keys.C2_priv, payload)
+
+        verified = []
+        verify = crypto.verify
+        crypto.verify = lambda *triple: verified.append(triple) or verify(*triple)
+        try:
+            response = self.client.post(reverse('rest:uome:accept-batch'),
+                                        {'author': self.user.key,
+                                         'signature': forged_signature,
+                                         'payload': payload})
+        finally:
+            crypto.verify = verify
+
+        assert response.status_code == 403
+        # only the envelope, not the signatures of the uomes
+        assert [triple[1:] for triple in verified] == [(forged_signature, payload)]
+        assert UOMe.objects.get(pk=uome1.pk).state == UOMe.CONFIRMED
+
+    def test_accept_many_uomes(self):
+        uome1, signature1 = self.pending_uome(self.lender1, 10)
+        uome2, signature2 = self.pending_uome(self.lender2, 20)
+        uome3, _ = self.pending_uome(self.lender2, 30)
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'uomes': [
+                                  {'uome_uuid': str(uome1.uuid), 'user_signature': signature1},
+                                  {'uome_uuid': str(uome2.uuid), 'user_signature': signature2},
+                                  {'uome_uuid': str(uome3.uuid), 'user_signature': signature1},
+                                  {'uome_uuid': 'not-a-uuid', 'user_signature': signature1},
+                              ]})
+        signature = crypto.sign(self.private_key, payload)
+
+        response = self.client.post(reverse('rest:uome:accept-batch'),
+                                    {'author': self.user.key,
+                                     'signature': signature,
+                                     'payload': payload})
+
+        assert response.status_code == 200
+        assert response['author'] == server_key
+        crypto.verify(server_key, response['signature'], response.content.decode())
+
+        payload = json.loads(response.content.decode())
+
+        assert payload['results'] == [
+            {'uome_uuid': str(uome1.uuid), 'accepted': True},
+            {'uome_uuid': str(uome2.uuid), 'accepted': True},
+            {'uome_uuid': str(uome3.uuid), 'accepted': False, 'error': 'invalid signature'},
+            {'uome_uuid': 'not-a-uuid', 'accepted': False, 'error': 'not found'},
+        ]
+
+        uomes = {uome.uuid: uome for uome in UOMe.objects.filter(group=self.group)}
+        assert uomes[uome1.uuid].borrower_signature == signature1
+        assert uomes[uome1.uuid].state == UOMe.ACCEPTED
+        assert uomes[uome2.uuid].borrower_signature == signature2
+        assert uomes[uome3.uuid].state == UOMe.CONFIRMED
+
+        totals = {user: user.balance for user in User.objects.filter(group=self.group)}
+        assert totals == {self.user: -30, self.lender1: 10, self.lender2: 20}
+
+        simplified_debt = defaultdict(dict)
+        for user_debt in UserDebt.objects.filter(group=self.group):
+            simplified_debt[user_debt.borrower][user_debt.lender] = user_debt.value
+
+        assert simplified_debt == {self.user: {self.lender1: 10, self.lender2: 20}}
+
+    def test_accepted_uome_is_not_accepted_again(self):
+        uome, uome_signature = self.pending_uome(self.lender1, 10)
+        entry = {'uome_uuid': str(uome.uuid), 'user_signature': uome_signature}
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user.key,
+                              'uomes': [entry, entry]})
+        signature = crypto.sign(self.private_key, payload)
+
+        response = self.client.post(reverse('rest:uome:accept-batch'),
+                                    {'author': self.user.key,
+                                     'signature': signature,
+                                     'payload': payload})
+
+        assert response.status_code == 200
+        results = json.loads(response.content.decode())['results']
+        assert [result['accepted'] for result in results] == [True, False]
+        assert results[1]['error'] == 'duplicate'
+
+        response = self.client.post(reverse('rest:uome:accept-batch'),
+                                    {'author': self.user.key,
+                                     'signature': signature,
+                                     'payload': payload})
+
+        results = json.loads(response.content.decode())['results']
+        assert [result['error'] for result in results] == ['not pending', 'not pending']
+        assert User.objects.get(key=self.user.key).balance == -10
+
+
+class AcceptQueryCountTests(TestCase):
+    def accept_with_existing_debts(self, borrower_keys, lender_key, debts) -> int:
+        """
+        Accepts a uome in a new group where `debts` other users already owe to the
+        lender, returning the number of queries made by the request
+        """
+        borrower_priv, borrower_pub = borrower_keys
+        group = Group.objects.create(name='test', key=example_keys.G1_pub)
+        borrower = User.objects.create(group=group, key=borrower_pub)
+        lender = User.objects.create(group=group, key=lender_key, balance=debts * 10)
+
+        for i in range(debts):
+            other_user = User.objects.create(group=group, key='%s-%d' % (group.uuid, i),
+                                             balance=-10)
+            UserDebt.objects.create(group=group, borrower=other_user, lender=lender,
+                                    value=10)
+
+        uome = UOMe.objects.create(group=group, lender=lender, borrower=borrower,
+                                   value=10, description='test', issuer_signature='meh')
+
+        borrower_payload = json.dumps({'group_uuid': str(group.uuid),
+                                       'issuer': lender.key,
+                                       'borrower': borrower.key,
+                                       'value': 10,
+                                       'description': 'test',
+                                       'uome_uuid': str(uome.uuid),
+                                       })
+        payload = json.dumps({'group_uuid': str(group.uuid),
+                              'user': borrower.key,
+                              'uome_uuid': str(uome.uuid),
+                              'user_signature': crypto.sign(borrower_priv, borrower_payload),
+                              })
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('rest:uome:accept'),
+                                        {'author': borrower.key,
+                                         'signature': crypto.sign(borrower_priv, payload),
+                                         'payload': payload})
+
+        assert response.status_code == 200
+        assert UserDebt.objects.filter(group=group).count() == debts + 1
+
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_number_of_debts(self):
+        few_debts = self.accept_with_existing_debts(
+            (example_keys.C1_priv, example_keys.C1_pub), example_keys.C2_pub, 1)
+        many_debts = self.accept_with_existing_debts(
+            (example_keys.C3_priv, example_keys.C3_pub), example_keys.C4_pub, 30)
+
+        assert few_debts == many_debts
+
+    def test_balances_are_written_with_one_statement(self):
+        group = Group.objects.create(name='test', key=example_keys.G1_pub)
+        borrower = User.objects.create(group=group, key=example_keys.C1_pub)
+        lender = User.objects.create(group=group, key=example_keys.C2_pub)
+        for i in range(10):  # users whose balance doesn't change
+            User.objects.create(group=group, key='%s-%d' % (group.uuid, i))
+
+        uome = UOMe.objects.create(group=group, lender=lender, borrower=borrower,
+                                   value=10, description='test', issuer_signature='meh')
+
+        borrower_payload = json.dumps({'group_uuid': str(group.uuid),
+                                       'issuer': lender.key,
+                                       'borrower': borrower.key,
+                                       'value': 10,
+                                       'description': 'test',
+                                       'uome_uuid': str(uome.uuid),
+                                       })
+        payload = json.dumps({'group_uuid': str(group.uuid),
+                              'user': borrower.key,
+                              'uome_uuid': str(uome.uuid),
+                              'user_signature': crypto.sign(example_keys.C1_priv,
+                                                            borrower_payload),
+                              })
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('rest:uome:accept'),
+                                        {'author': borrower.key,
+                                         'signature': crypto.sign(example_keys.C1_priv,
+                                                                  payload),
+                                         'payload': payload})
+
+        assert response.status_code == 200
+
+        user_updates = [query['sql'] for query in queries.captured_queries
+                        if query['sql'].startswith('UPDATE "rest_app_user"')]
+        assert len(user_updates) == 1
+
+        balances = dict(User.objects.filter(group=group).exclude(balance=0)
+                        .values_list('key', 'balance'))
+        assert balances == {borrower.key: -10, lender.key: 10}
+
 
 class GetTotalsTests(TestCase):
     def setUp(self):
@@ -406,3 +1215,77 @@ class GetTotalsTests(TestCase):
 
         assert payload['user_balance'] == -uome.value
         assert payload['suggested_transactions'] == {self.user2.key: uome.value}
+
+    def test_query_count_does_not_depend_on_number_of_debts(self):
+        self.user1.balance = -30
+        self.user1.save()
+        for lender in (self.user2, self.user3):
+            lender.balance = 15
+            lender.save()
+            UserDebt.objects.create(group=self.group, lender=lender, borrower=self.user1,
+                                    value=15)
+
+        # the user with its group and the suggested transactions
+        with self.assertNumQueries(2):
+            response = self.client.post(reverse('rest:uome:get-totals'),
+                                        {'author': self.key,
+                                         'signature': self.signature,
+                                         'payload': self.payload})
+
+        assert response.status_code == 200
+
+        payload = json.loads(response.content.decode())
+
+        assert payload['user_balance'] == -30
+        assert payload['suggested_transactions'] == {self.user2.key: 15, self.user3.key: 15}
+
+    def test_unchanged_totals_are_served_from_cache(self):
+        self.client.post(reverse('rest:uome:get-totals'),
+                         {'author': self.key,
+                          'signature': self.signature,
+                          'payload': self.payload})
+
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse('rest:uome:get-totals'),
+                                        {'author': self.key,
+                                         'signature': self.signature,
+                                         'payload': self.payload})
+
+        assert response.status_code == 200
+        assert json.loads(response.content.decode())['user_balance'] == 0
+
+        # a change to the balances invalidates the cached totals
+        self.user1.balance = -10
+        self.user1.save()
+
+        response = self.client.post(reverse('rest:uome:get-totals'),
+                                    {'author': self.key,
+                                     'signature': self.signature,
+                                     'payload': self.payload})
+
+        assert json.loads(response.content.decode())['user_balance'] == -10
+
+    def test_totals_not_modified_when_version_is_current(self):
+        response = self.client.post(reverse('rest:uome:get-totals'),
+                                    {'author': self.key,
+                                     'signature': self.signature,
+                                     'payload': self.payload})
+        version = json.loads(response.content.decode())['version']
+
+        payload = json.dumps({'group_uuid': str(self.group.uuid),
+                              'user': self.user1.key,
+                              'user_signature': self.user_signature,
+                              'version': version,
+                              })
+        response = self.client.post(reverse('rest:uome:get-totals'),
+                                    {'author': self.key,
+                                     'signature': crypto.sign(self.private_key, payload),
+                                     'payload': payload})
+
+        assert response.status_code == 200
+        assert response['author'] == server_key
+        crypto.verify(server_key, response['signature'], response.content.decode())
+        assert json.loads(response.content.decode()) == {'group_uuid': str(self.group.uuid),
+                                                         'user': self.user1.key,
+                                                         'version': version,
+                                                         'not_modified': True}
@@ -4,9 +4,13 @@ from . import views
 
 urlpatterns = [
     url(r'^issue/', views.issue, name='issue'),
+    url(r'^issue-batch/', views.issue_batch, name='issue-batch'),
     url(r'^confirm/', views.confirm, name='confirm'),
+    url(r'^confirm-batch/', views.confirm_batch, name='confirm-batch'),
     url(r'^cancel/', views.cancel, name='cancel'),
     url(r'^get-pending/', views.get_pending, name='get-pending'),
+    url(r'^wait-pending/', views.wait_pending, name='wait-pending'),
     url(r'^accept/', views.accept, name='accept'),
+    url(r'^accept-batch/', views.accept_batch, name='accept-batch'),
     url(r'^get-totals/', views.get_totals, name='get-totals'),
 ]
@@ -1,21 +1,115 @@
 import json
 import logging
+import uuid
 from collections import defaultdict
 
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import transaction
+from django.db.models import Case, CharField, F, IntegerField, PositiveIntegerField, Value, When
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.views.decorators.http import require_POST
 
 from groupbank_crypto import ec_secp256k1 as crypto
-from rest_app.decorators import verify_author
+from rest_app import metrics, routers, timing
+from rest_app.decorators import (pin_author_to_primary, query_budget, read_from_replica,
+                                 verify_author)
+from rest_app.notifications import TooManyWaiters, pending_notifications
+from rest_app.totals import load_totals, totals_cache
 from rest_app.models import Group, User, UOMe, UOME_DESCRIPTION_MAX_LENGTH, UserDebt
 from rest_app.utils import simplify_debt
 
 logger = logging.getLogger(__name__)
 
 
+def _not_modified(group_uuid, user_key, version):
+    """
+    The response to a polling request when the group didn't change since the version
+    the user already has. It's still signed, and names the group, user and version so
+    that it can't be replayed for another request
+    """
+    return HttpResponse(json.dumps({'group_uuid': str(group_uuid),
+                                    'user': user_key,
+                                    'version': version,
+                                    'not_modified': True,
+                                    }), status=200)
+
+
+def _bump_version(group_uuid):
+    """
+    Marks that the pending UOMe's or the totals of a group changed, so that the clients
+    polling them with the previous version get the new ones
+    """
+    Group.objects.filter(pk=group_uuid).update(version=F('version') + 1)
+    totals_cache.invalidate(str(group_uuid))
+
+
+def _lock_group(group):
+    """
+    Locks the row of the group until the end of the transaction, so that writes to the
+    balances and the simplified debt of a group happen one at a time while the other
+    groups aren't blocked. On SQLite the whole database is locked by the writes anyway
+    """
+    list(Group.objects.select_for_update().filter(pk=group.pk).values_list('pk'))
+
+
+def _update_group_debt(group, new_uomes):
+    """
+    Applies a list of new UOMe's ([borrower, lender, value]) to the balances and the
+    simplified debt of a group, writing only the rows that actually changed
+    """
+    totals = defaultdict(int)
+    for key, balance in User.objects.filter(group=group).values_list('key', 'balance'):
+        totals[key] = balance
+    previous_totals = dict(totals)
+    metrics.accept_group_size.observe(len(previous_totals))
+
+    previous_debt = defaultdict(dict)
+    debt_ids = {}  # the id of the row of each edge, like {('user1', 'user2'): 3}
+    for debt_id, borrower, lender, value in UserDebt.objects.filter(group=group).values_list(
+            'id', 'borrower_id', 'lender_id', 'value'):
+        previous_debt[borrower][lender] = value
+        debt_ids[borrower, lender] = debt_id
+
+    with timing.phase('simplify_debt'):
+        new_totals, new_simplified_debt = simplify_debt.update_total_debt(
+            totals, new_uomes, strategy=settings.DEBT_SIMPLIFICATION_STRATEGY,
+            previous_debt=previous_debt)
+
+        changed_balances = {key: balance for key, balance in new_totals.items()
+                            if balance != previous_totals.get(key, 0)}
+
+        added, changed, removed = simplify_debt.diff_simplified_debt(previous_debt,
+                                                                     new_simplified_debt)
+
+    if changed_balances:  # a single UPDATE ... SET balance = CASE key ... for all of them
+        User.objects.filter(group=group, key__in=changed_balances).update(
+            balance=Case(*[When(key=key, then=Value(balance))
+                           for key, balance in changed_balances.items()],
+                         output_field=IntegerField()))
+
+    if removed:
+        UserDebt.objects.filter(
+            pk__in=[debt_ids[borrower, lender] for borrower, lender in removed]).delete()
+
+    if changed:  # a single UPDATE ... SET value = CASE id ... for all changed edges
+        UserDebt.objects.filter(
+            pk__in=[debt_ids[borrower, lender] for borrower, lender, _ in changed]
+        ).update(value=Case(*[When(pk=debt_ids[borrower, lender], then=Value(value))
+                              for borrower, lender, value in changed],
+                            output_field=PositiveIntegerField()))
+
+    if added:
+        UserDebt.objects.bulk_create([UserDebt(group=group, borrower_id=borrower,
+                                               lender_id=lender, value=value)
+                                      for borrower, lender, value in added])
+
+    # the bulk writes above don't send the signals that invalidate the totals
+    totals_cache.invalidate(str(group.uuid))
+
+
 @verify_author
+@pin_author_to_primary
 @require_POST
 def issue(request):
     """
@@ -45,7 +139,8 @@ def issue(request):
     auth_payload = json.dumps({'group_uuid': str(group_uuid), 'user': user_id})
 
     try:
-        crypto.verify(user_id, auth_signature, auth_payload)
+        request.signatures.add(user_id, auth_signature, auth_payload)
+        request.signatures.verify()
     except (crypto.InvalidKey, crypto.InvalidSignature):
         logger.info('Request with invalid signature or key by author %s' % user_id)
         return HttpResponseForbidden()
@@ -74,6 +169,8 @@ def issue(request):
     # TODO: the description can leak information, maybe it should be encrypted
     uome = UOMe.objects.create(group=group, lender=user, borrower=borrower, value=value,
                                description=description)
+    _bump_version(group.uuid)
+    pending_notifications.publish_on_commit(str(group.uuid), [user.key, borrower.key])
 
     response = json.dumps({'group_uuid': str(group.uuid),
                            'user': user.key,
@@ -86,7 +183,111 @@ def issue(request):
     return HttpResponse(response, status=201)
 
 
+@transaction.atomic
 @verify_author
+@pin_author_to_primary
+@require_POST
+def issue_batch(request):
+    """
+    Used by a user to issue unconfirmed UOMe's to many other users at once, e.g. to
+    split an expense. Either all the UOMe's are issued or none is
+    """
+    try:
+        payload = json.loads(request.POST['payload'])
+    except json.JSONDecodeError:
+        logger.info('Malformed request')
+        return HttpResponseBadRequest()
+
+    try:
+        group_uuid = payload['group_uuid']
+        user_id = payload['user']
+        auth_signature = payload['user_signature']
+        # a list like [{'borrower': key1, 'value': 10, 'description': 'dinner'}, ...]
+        entries = [(entry['borrower'], entry['value'], entry['description'])
+                   for entry in payload['uomes']]
+    except (KeyError, TypeError):
+        logger.info('Request with missing attributes')
+        return HttpResponseBadRequest()
+
+    if request.POST['author'] != user_id:
+        logger.info('Request made by unauthorized author %s' % request.POST['author'])
+        return HttpResponse('401 Unauthorized', status=401)
+
+    auth_payload = json.dumps({'group_uuid': str(group_uuid), 'user': user_id})
+
+    try:
+        request.signatures.add(user_id, auth_signature, auth_payload)
+        request.signatures.verify()
+    except (crypto.InvalidKey, crypto.InvalidSignature):
+        logger.info('Request with invalid signature or key by author %s' % user_id)
+        return HttpResponseForbidden()
+
+    if not entries:
+        logger.info('Request tried to issue an empty list of uomes (user %s)', user_id)
+        return HttpResponseBadRequest()
+
+    for borrower_id, value, description in entries:
+        if not isinstance(borrower_id, str):
+            logger.info('Request tried to issue a uome with invalid borrower (user %s)',
+                        user_id)
+            return HttpResponseBadRequest()
+
+        # So it's not possible to invert the direction of the UOMe
+        if not isinstance(value, int) or value <= 0:
+            logger.info('Request tried to issue a uome with invalid value (user %s)', user_id)
+            return HttpResponseBadRequest()
+
+        if not isinstance(description, str) or \
+                len(description) > UOME_DESCRIPTION_MAX_LENGTH:
+            logger.info('Request tried to issue a uome with invalid description (user %s)',
+                        user_id)
+            return HttpResponseBadRequest()
+
+        if borrower_id == user_id:  # That would just be weird...
+            logger.info('Request tried to issue a uome from a user (%s) to themselves',
+                        user_id)
+            return HttpResponseBadRequest()
+
+    borrower_ids = set(borrower_id for borrower_id, _, _ in entries)
+
+    try:  # check that the group exists and get it
+        group = Group.objects.get(pk=group_uuid)
+        # the user and all the borrowers with a single query
+        users = set(User.objects.filter(group=group, key__in=borrower_ids | {user_id})
+                    .values_list('key', flat=True))
+    except (ValidationError, ObjectDoesNotExist):  # ValidationError if key is not valid
+        logger.info('Request tried to issue uomes for non-existent group %s' % group_uuid)
+        return HttpResponseBadRequest()
+
+    if user_id not in users or not borrower_ids <= users:
+        logger.info('Request tried to issue uomes for non-existent user %s or borrowers %s'
+                    % (user_id, borrower_ids - users))
+        return HttpResponseBadRequest()
+
+    # the uuids are generated before the insert, so bulk_create returns them
+    uomes = UOMe.objects.bulk_create([UOMe(group=group, lender_id=user_id,
+                                           borrower_id=borrower_id, value=value,
+                                           description=description)
+                                      for borrower_id, value, description in entries])
+    _bump_version(group.uuid)
+    pending_notifications.publish_on_commit(str(group.uuid), borrower_ids | {user_id})
+
+    response = json.dumps({'group_uuid': str(group.uuid),
+                           'user': user_id,
+                           'uomes': [{'borrower': uome.borrower_id,
+                                      'value': uome.value,
+                                      'description': uome.description,
+                                      'uome_uuid': str(uome.uuid)}
+                                     for uome in uomes],
+                           })
+
+    logger.info('%d new uomes issued in group %s by user %s'
+                % (len(uomes), group_uuid, user_id))
+    return HttpResponse(response, status=201)
+
+
+@verify_author
+@pin_author_to_primary
 @require_POST
 def confirm(request):
     """
@@ -130,7 +331,8 @@ def confirm(request):
     })
 
     try:
-        crypto.verify(user_id, user_signature, uome_payload)
+        request.signatures.add(user_id, user_signature, uome_payload)
+        request.signatures.verify()
     except (crypto.InvalidKey, crypto.InvalidSignature):
         logger.info('Request with invalid signature or key by author %s' % user_id)
         return HttpResponseForbidden()
@@ -138,6 +340,9 @@ def confirm(request):
     # TODO: the description can leak information, maybe it should be encrypted
     uome.issuer_signature = payload['user_signature']
     uome.save()
+    _bump_version(uome.group_id)
+    pending_notifications.publish_on_commit(str(uome.group_id),
+                                            [uome.lender_id, uome.borrower_id])
 
     # user created, create the response object
     response = json.dumps({'group_uuid': str(group.uuid), 'user': user.key})
@@ -146,7 +351,132 @@ def confirm(request):
     return HttpResponse(response, status=200)
 
 
+@transaction.atomic
+@verify_author
+@pin_author_to_primary
+@require_POST
+def confirm_batch(request):
+    """
+    Used by a user to confirm many unconfirmed UOMe's issued by them at once
+    """
+    try:
+        payload = json.loads(request.POST['payload'])
+    except json.JSONDecodeError:
+        logger.info('Malformed request')
+        return HttpResponseBadRequest()
+
+    try:
+        group_uuid = payload['group_uuid']
+        user_id = payload['user']
+        # a list like [{'uome_uuid': uuid1, 'user_signature': signature1}, ...]
+        entries = [(str(entry['uome_uuid']), entry['user_signature'])
+                   for entry in payload['uomes']]
+    except (KeyError, TypeError):
+        logger.info('Request with missing attributes')
+        return HttpResponseBadRequest()
+
+    if request.POST['author'] != user_id:
+        logger.info('Request made by unauthorized author %s' % request.POST['author'])
+        return HttpResponse('401 Unauthorized', status=401)
+
+    try:  # check that the group and the user exist and get them with a single query
+        user = User.objects.select_related('group').get(group_id=group_uuid, key=user_id)
+        group = user.group
+    except (ValidationError, ObjectDoesNotExist):  # ValidationError if the key is invalid
+        logger.info('Request tried to confirm uomes for non-existent group %s'
+                    ', user %s' % (group_uuid, user_id))
+        return HttpResponseBadRequest()
+
+    valid_uuids = {}  # the uuids as sent by the user -> their canonical form
+    for uome_uuid, _ in entries:
+        try:
+            valid_uuids[uome_uuid] = str(uuid.UUID(uome_uuid))
+        except ValueError:
+            pass
+
+    uomes = {str(uome.uuid): uome for uome in UOMe.objects.filter(
+        group=group, uuid__in=list(valid_uuids.values()))}
+
+    checked = []  # (uuid as sent, uome, signature, error, signed triple) of each entry
+    seen = set()
+    for uome_uuid, user_signature in entries:
+        uome = uomes.get(valid_uuids.get(uome_uuid))
+        triple = None
+
+        if uome is None:
+            error = 'not found'
+        elif str(uome.uuid) in seen:
+            error = 'duplicate'
+        elif uome.lender_id != user.key:
+            error = 'unauthorized'
+        elif uome.state != UOMe.ISSUED:
+            error = 'already confirmed'
+        else:
+            error = None
+            seen.add(str(uome.uuid))
+            triple = (user.key, user_signature, json.dumps({
+                'group_uuid': str(uome.group_id),
+                'user': uome.lender_id,
+                'borrower': uome.borrower_id,
+                'value': uome.value,
+                'description': uome.description,
+                'uome_uuid': str(uome.uuid),
+            }))
+        checked.append((uome_uuid, uome, user_signature, error, triple))
+
+    # the signatures of all the entries at once, an invalid one only rejects its entry
+    invalid = request.signatures.verify(
+        optional=[triple for *_, triple in checked if triple is not None])
+
+    results = []
+    confirmed = {}  # uome uuid -> issuer signature
+    for uome_uuid, uome, user_signature, error, triple in checked:
+        if triple in invalid:
+            error = 'invalid signature'
+
+        if error is None:
+            confirmed[str(uome.uuid)] = user_signature
+            results.append({'uome_uuid': str(uome.uuid), 'confirmed': True})
+        else:
+            results.append({'uome_uuid': uome_uuid, 'confirmed': False, 'error': error})
+
+    if confirmed:
+        # some uomes could have been confirmed or accepted by a concurrent request since
+        # they were read, those are left as they are
+        updated = UOMe.objects.filter(pk__in=confirmed, state=UOMe.ISSUED).update(
+            issuer_signature=Case(*[When(pk=uome_uuid, then=Value(user_signature))
+                                    for uome_uuid, user_signature in confirmed.items()],
+                                  output_field=CharField()),
+            state=UOMe.CONFIRMED)
+
+        if updated < len(confirmed):
+            confirmed_now = set(
+                str(uome_uuid) for uome_uuid, state, issuer_signature
+                in UOMe.objects.filter(pk__in=confirmed).values_list(
+                    'uuid', 'state', 'issuer_signature')
+                if state == UOMe.CONFIRMED and issuer_signature == confirmed[str(uome_uuid)])
+            for result in results:
+                if result['confirmed'] and result['uome_uuid'] not in confirmed_now:
+                    del confirmed[result['uome_uuid']]
+                    result.update({'confirmed': False, 'error': 'already confirmed'})
+
+    if confirmed:
+        _bump_version(group.uuid)
+        pending_notifications.publish_on_commit(
+            str(group.uuid),
+            {user.key} | set(uomes[uome_uuid].borrower_id for uome_uuid in confirmed))
+
+    response = json.dumps({'group_uuid': str(group.uuid),
+                           'user': user.key,
+                           'results': results,
+                           })
+
+    logger.info('%d UOMes were confirmed by user %s' % (len(confirmed), user_id))
+    return HttpResponse(response, status=200)
+
+
 @verify_author
+@pin_author_to_primary
 @require_POST
 def cancel(request):
     """
@@ -179,7 +509,7 @@ def cancel(request):
                     ', user %s' % (uome_uuid, group_uuid, user_id))
         return HttpResponseBadRequest()
 
-    if user.key == uome.lender.key and uome.borrower_signature == '':
+    if user.key == uome.lender_id and uome.state != UOMe.ACCEPTED:
 
         response = json.dumps({'group_uuid': str(group.uuid),
                                'user': user.key,
@@ -187,6 +517,7 @@ def cancel(request):
                                })
 
         uome.delete()
+        _bump_version(group.uuid)
 
         logger.info('UOMe %s was deleted' % uome_uuid)
         return HttpResponse(response, status=200)
@@ -194,7 +525,11 @@ def cancel(request):
         return HttpResponseForbidden()
 
 
+# the user with its group and one query for each list, and the user again if the
+# replica is lagging behind
+@query_budget(4)
 @verify_author
+@read_from_replica
 @require_POST
 def get_pending(request):
     """
@@ -214,13 +549,28 @@ def get_pending(request):
         logger.info('Request with missing attributes')
         return HttpResponseBadRequest()
 
+    # the version of the group in the last response the user got, if any
+    known_version = payload.get('version')
+
     if request.POST['author'] != user_id:
         logger.info('Request made by unauthorized author %s' % request.POST['author'])
         return HttpResponse('401 Unauthorized', status=401)
 
-    try:  # check that the group exists and get it
-        group = Group.objects.get(pk=group_uuid)
-        user = User.objects.get(group=group, key=user_id)
+    try:  # check that the group and the user exist and get them with a single query
+        user = User.objects.select_related('group').get(group_id=group_uuid, key=user_id)
+        group = user.group
+
+        # the user already got a newer version of the group, maybe from another process
+        # (the users pinned to the primary are only known by the process they wrote in),
+        # so the replica is lagging behind and would take the user back in time
+        if routers.using_replica() and isinstance(known_version, int) and \
+                known_version > group.version:
+            logger.info('Replica is behind version %d of group %s, reading from primary'
+                        % (known_version, group_uuid))
+            routers.leave_replica()
+            user = User.objects.select_related('group').get(group_id=group_uuid,
+                                                            key=user_id)
+            group = user.group
     except (ValidationError, ObjectDoesNotExist):  # ValidationError if the key is invalid
         logger.info('Request tried accessing pending uomes for non-existent group %s'
                     ', user %s' % (group_uuid, user_id))
@@ -231,36 +581,126 @@ def get_pending(request):
                                })
 
     try:  # verify the signatures
-        crypto.verify(user.key, auth_signature, auth_payload)
+        request.signatures.add(user.key, auth_signature, auth_payload)
+        request.signatures.verify()
     except (crypto.InvalidKey, crypto.InvalidSignature):
         logger.info('Request with invalid signature or key by author %s' % user_id)
         return HttpResponseForbidden()
 
+    if known_version is not None and known_version == group.version:
+        logger.info('Pending uome list of user %s not modified' % user_id)
+        return _not_modified(group.uuid, user.key, group.version)
+
     # TODO: add a test for uome's without issuer signatures
-    uomes_by_user = UOMe.objects.filter(group=group, borrower_signature='',
-                                        lender=user).exclude(issuer_signature='')
-    uomes_for_user = UOMe.objects.filter(group=group, borrower_signature='',
-                                         borrower=user).exclude(issuer_signature='')
-    issued_by_user = []
-    for uome in uomes_by_user:
-        issued_by_user.append(uome.to_dict_unconfirmed())
-    waiting_for_user = []
-    for uome in uomes_for_user:
-        waiting_for_user.append(uome.to_dict_unconfirmed())
+    uomes_by_user = UOMe.objects.filter(group=group, lender=user, state=UOMe.CONFIRMED)
+    uomes_for_user = UOMe.objects.filter(group=group, borrower=user, state=UOMe.CONFIRMED)
+    issued_by_user = UOMe.dicts_unconfirmed(uomes_by_user)
+    waiting_for_user = UOMe.dicts_unconfirmed(uomes_for_user)
 
-    response = json.dumps({'group_uuid': str(group.uuid),
+    with timing.phase('json'):  # the lists of pending UOMe's can get long
+        response = json.dumps({'group_uuid': str(group.uuid),
+                               'user': user.key,
+                               'version': group.version,
+                               'issued_by_user': json.dumps(issued_by_user),
+                               'waiting_for_user': json.dumps(waiting_for_user),
+                               })
+
+    logger.info('Sent pending uome list to user %s' % user_id)
+    return HttpResponse(response, status=200)
+
+
+@verify_author
+@require_POST
+def wait_pending(request):
+    """
+    Used by a user to wait for new pending UOMe's issued to/by them instead of polling
+    get-pending. Answers as soon as there are some, or after a timeout. When too many
+    users are waiting already, answers 429 right away and the user should poll instead
+    """
+    try:
+        payload = json.loads(request.POST['payload'])
+    except json.JSONDecodeError:
+        logger.info('Malformed request')
+        return HttpResponseBadRequest()
+
+    try:
+        group_uuid = payload['group_uuid']
+        user_id = payload['user']
+        auth_signature = payload['user_signature']
+    except KeyError:
+        logger.info('Request with missing attributes')
+        return HttpResponseBadRequest()
+
+    # the version of the group in the last get-pending response the user got, if any
+    known_version = payload.get('version')
+    timeout = payload.get('timeout', settings.LONG_POLL_TIMEOUT)
+
+    if not isinstance(timeout, (int, float)) or timeout < 0:
+        logger.info('Request with invalid timeout')
+        return HttpResponseBadRequest()
+
+    if request.POST['author'] != user_id:
+        logger.info('Request made by unauthorized author %s' % request.POST['author'])
+        return HttpResponse('401 Unauthorized', status=401)
+
+    try:  # the group uuid is a key of the notifications, so it must be canonical
+        group_uuid = str(uuid.UUID(str(group_uuid)))
+    except ValueError:
+        logger.info('Request tried waiting for pending uomes of invalid group %s'
+                    % group_uuid)
+        return HttpResponseBadRequest()
+
+    # taken before reading the version, so that nothing published after it is missed
+    since = pending_notifications.current(group_uuid, user_id)
+
+    try:  # check that the group and the user exist and get them with a single query
+        user = User.objects.select_related('group').get(group_id=group_uuid, key=user_id)
+        group = user.group
+    except (ValidationError, ObjectDoesNotExist):  # ValidationError if the key is invalid
+        logger.info('Request tried waiting for pending uomes for non-existent group %s'
+                    ', user %s' % (group_uuid, user_id))
+        return HttpResponseBadRequest()
+
+    auth_payload = json.dumps({'group_uuid': str(group.uuid),
+                               'user': user.key,
+                               })
+
+    try:  # verify the signatures
+        request.signatures.add(user.key, auth_signature, auth_payload)
+        request.signatures.verify()
+    except (crypto.InvalidKey, crypto.InvalidSignature):
+        logger.info('Request with invalid signature or key by author %s' % user_id)
+        return HttpResponseForbidden()
+
+    # something changed since the last get-pending of the user, don't wait at all
+    changed = known_version is not None and known_version != group.version
+
+    if not changed:
+        try:
+            changed = pending_notifications.wait(group_uuid, user.key, since,
+                                                 min(timeout, settings.LONG_POLL_TIMEOUT))
+        except TooManyWaiters:
+            logger.info('Too many users waiting for pending uomes, turned away user %s'
+                        % user_id)
+            response = HttpResponse('429 Too Many Requests', status=429)
+            response['Retry-After'] = settings.LONG_POLL_TIMEOUT
+            return response
+
+    response = json.dumps({'group_uuid': group_uuid,
                            'user': user.key,
-                           'issued_by_user': json.dumps(issued_by_user),
-                           'waiting_for_user': json.dumps(waiting_for_user),
+                           'changed': changed,
                            })
 
-    logger.info('Sent pending uome list to user %s' % user_id)
+    logger.info('Pending uome notification (%s) sent to user %s' % (changed, user_id))
     return HttpResponse(response, status=200)
 
 
-# TODO: Think about data races a lot more
+# 4 reads (with the lock), the uome, the balances and debts, at most 5 writes of the
+# debt (a delete selects the rows first) and the version: at most 13, with some slack
 @transaction.atomic
+@query_budget(15)
 @verify_author
+@pin_author_to_primary
 @require_POST
 def accept(request):
     """
@@ -290,60 +730,177 @@ def accept(request):
                     ', user %s or uome %s' % (group_uuid, user_id, uome_uuid))
         return HttpResponseBadRequest()
 
-    if request.POST['author'] != user_id or request.POST['author'] != uome.borrower.key:
+    if request.POST['author'] != user_id or request.POST['author'] != uome.borrower_id:
         logger.info('Request made by unauthorized author %s' % request.POST['author'])
         return HttpResponse('401 Unauthorized', status=401)
 
-    uome_payload = json.dumps({'group_uuid': str(uome.group.uuid),
-                               'issuer': uome.lender.key,
-                               'borrower': uome.borrower.key,
+    # the foreign keys of the uome are the group uuid and the user keys, reading them
+    # doesn't load the related objects
+    uome_payload = json.dumps({'group_uuid': str(uome.group_id),
+                               'issuer': uome.lender_id,
+                               'borrower': uome.borrower_id,
                                'value': uome.value,
                                'description': uome.description,
                                'uome_uuid': str(uome.uuid),
                                })
 
     try:  # verify the signatures
-        crypto.verify(user.key, uome_signature, uome_payload)
+        request.signatures.add(user.key, uome_signature, uome_payload)
+        request.signatures.verify()
     except (crypto.InvalidKey, crypto.InvalidSignature):
         logger.info('Request with invalid signature or key by author %s' % user_id)
         return HttpResponseForbidden()
 
-    uome.borrower_signature = uome_signature
-    uome.save()
+    # from here on, the accepts of this group wait for each other
+    _lock_group(group)
+
+    # the uome could have been accepted by a concurrent request in the meantime
+    if not UOMe.objects.filter(pk=uome.pk).exclude(state=UOMe.ACCEPTED).update(
+            borrower_signature=uome_signature, state=UOMe.ACCEPTED):
+        logger.info('Request tried accepting the already accepted uome %s' % uome_uuid)
+        return HttpResponseBadRequest()
 
     # update the balances and suggestions of users
-    group_users = User.objects.filter(group=group)
+    _update_group_debt(group, [[uome.borrower_id, uome.lender_id, uome.value]])
+    _bump_version(group.uuid)
 
-    totals = defaultdict(int)
-    for group_user in group_users:
-        totals[group_user.key] = group_user.balance
+    response = json.dumps({'group_uuid': str(uome.group_id),
+                           'user': user.key,
+                           'uome_uuid': str(uome.uuid),
+                           })
+
+    logger.info('UOMe %s was accepted by user %s' % (str(uome_uuid), user_id))
+    return HttpResponse(response, status=200)
+
+
+# like accept, with a single query for all the uomes
+@transaction.atomic
+@query_budget(15)
+@verify_author
+@pin_author_to_primary
+@require_POST
+def accept_batch(request):
+    """
+    Used by a user to accept many pending UOMe's issued to them at once. The balances
+    and the simplified debt of the group are only updated once for all of them
+    """
+    try:
+        payload = json.loads(request.POST['payload'])
+    except json.JSONDecodeError:
+        logger.info('Malformed request')
+        return HttpResponseBadRequest()
 
-    new_uome = [uome.borrower.key, uome.lender.key, uome.value]
-    new_totals, new_simplified_debt = simplify_debt.update_total_debt(totals, [new_uome])
+    try:
+        group_uuid = payload['group_uuid']
+        user_id = payload['user']
+        # a list like [{'uome_uuid': uuid1, 'user_signature': signature1}, ...]
+        entries = [(str(entry['uome_uuid']), entry['user_signature'])
+                   for entry in payload['uomes']]
+    except (KeyError, TypeError):
+        logger.info('Request with missing attributes')
+        return HttpResponseBadRequest()
 
-    for group_user in group_users:
-        group_user.balance = new_totals[group_user.key]
-        group_user.save()
+    if request.POST['author'] != user_id:
+        logger.info('Request made by unauthorized author %s' % request.POST['author'])
+        return HttpResponse('401 Unauthorized', status=401)
 
-    # drop the previous user debt for this group, since it's now useless
-    UserDebt.objects.filter(group=group).delete()
+    try:  # check that the group and the user exist and get them with a single query
+        user = User.objects.select_related('group').get(group_id=group_uuid, key=user_id)
+        group = user.group
+    except (ValidationError, ObjectDoesNotExist):  # ValidationError if the key is invalid
+        logger.info('Request tried accepting uomes for non-existent group %s'
+                    ', user %s' % (group_uuid, user_id))
+        return HttpResponseBadRequest()
 
-    for borrower, user_debts in new_simplified_debt.items():
-        # debts is a dict of users this borrower owes to, like {'user1': 3, 'user2':8}
-        for lender, value in user_debts.items():
-            UserDebt.objects.create(group=group, value=value,
-                                    borrower=User.objects.get(key=borrower),
-                                    lender=User.objects.get(key=lender))
+    valid_uuids = {}  # the uuids as sent by the user -> their canonical form
+    for uome_uuid, _ in entries:
+        try:
+            valid_uuids[uome_uuid] = str(uuid.UUID(uome_uuid))
+        except ValueError:
+            pass
+
+    uomes = {str(uome.uuid): uome for uome in UOMe.objects.filter(
+        group=group, uuid__in=list(valid_uuids.values()))}
+
+    checked = []  # (uuid as sent, uome, signature, error, signed triple) of each entry
+    seen = set()
+    for uome_uuid, uome_signature in entries:
+        uome = uomes.get(valid_uuids.get(uome_uuid))
+        triple = None
+
+        if uome is None:
+            error = 'not found'
+        elif str(uome.uuid) in seen:
+            error = 'duplicate'
+        elif uome.borrower_id != user.key:
+            error = 'unauthorized'
+        elif uome.state != UOMe.CONFIRMED:
+            error = 'not pending'
+        else:
+            error = None
+            seen.add(str(uome.uuid))
+            triple = (user.key, uome_signature, json.dumps({
+                'group_uuid': str(uome.group_id),
+                'issuer': uome.lender_id,
+                'borrower': uome.borrower_id,
+                'value': uome.value,
+                'description': uome.description,
+                'uome_uuid': str(uome.uuid),
+            }))
+        checked.append((uome_uuid, uome, uome_signature, error, triple))
+
+    # the signatures of all the entries at once, an invalid one only rejects its entry
+    invalid = request.signatures.verify(
+        optional=[triple for *_, triple in checked if triple is not None])
+
+    results = []
+    accepted = {}  # uome uuid -> borrower signature
+    for uome_uuid, uome, uome_signature, error, triple in checked:
+        if triple in invalid:
+            error = 'invalid signature'
+
+        if error is None:
+            accepted[str(uome.uuid)] = uome_signature
+            results.append({'uome_uuid': str(uome.uuid), 'accepted': True})
+        else:
+            results.append({'uome_uuid': uome_uuid, 'accepted': False, 'error': error})
+
+    if accepted:
+        # from here on, the accepts of this group wait for each other
+        _lock_group(group)
+
+        # some uomes could have been accepted by a concurrent request in the meantime
+        still_pending = set(str(uome_uuid) for uome_uuid in UOMe.objects.filter(
+            pk__in=accepted, state=UOMe.CONFIRMED).values_list('uuid', flat=True))
+        for result in results:
+            if result['accepted'] and result['uome_uuid'] not in still_pending:
+                del accepted[result['uome_uuid']]
+                result.update({'accepted': False, 'error': 'not pending'})
+
+    if accepted:
+        UOMe.objects.filter(pk__in=accepted).update(
+            borrower_signature=Case(*[When(pk=uome_uuid, then=Value(uome_signature))
+                                      for uome_uuid, uome_signature in accepted.items()],
+                                    output_field=CharField()),
+            state=UOMe.ACCEPTED)
+
+        # update the balances and suggestions of users once for all the uomes
+        _update_group_debt(group, [[uomes[uome_uuid].borrower_id,
+                                    uomes[uome_uuid].lender_id,
+                                    uomes[uome_uuid].value] for uome_uuid in accepted])
+        _bump_version(group.uuid)
 
-    response = json.dumps({'group_uuid': str(uome.group.uuid),
+    response = json.dumps({'group_uuid': str(group.uuid),
                            'user': user.key,
-                           'uome_uuid': str(uome.uuid),
+                           'results': results,
                            })
 
-    logger.info('UOMe %s was accepted by user %s' % (str(uome_uuid), user_id))
+    logger.info('%d UOMes were accepted by user %s' % (len(accepted), user_id))
     return HttpResponse(response, status=200)
 
 
+# the balances and the debts of the group, when they aren't cached
+@query_budget(2)
 @verify_author
 @require_POST
 def get_totals(request):
@@ -364,42 +921,63 @@ def get_totals(request):
         logger.info('Request with missing attributes')
         return HttpResponseBadRequest()
 
-    try:  # check that the group exists and get it
-        group = Group.objects.get(pk=group_uuid)
-        user = User.objects.get(group=group, key=user_id)
-    except (ValidationError, ObjectDoesNotExist):  # ValidationError if the key is invalid
+    # the version of the group in the last response the user got, if any
+    known_version = payload.get('version')
+
+    try:  # the group uuid is a cache key, so it must be in its canonical form
+        group_uuid = str(uuid.UUID(str(group_uuid)))
+    except ValueError:
+        logger.info('Request tried to get the totals for invalid group %s' % group_uuid)
+        return HttpResponseBadRequest()
+
+    # the database is only read when the group changed since the last request
+    totals, version = totals_cache.get(group_uuid)
+    if totals is None:
+        totals = load_totals(group_uuid)
+        if totals['balances']:  # groups without users don't exist, or don't matter
+            totals_cache.set(group_uuid, version, totals)
+
+    if not isinstance(user_id, str) or user_id not in totals['balances']:
         logger.info('Request tried to get the totals for non-existent group %s'
                     'or user %s' % (group_uuid, user_id))
         return HttpResponseBadRequest()
 
-    user_payload = json.dumps({'group_uuid': str(group.uuid),
-                               'user': user.key,
+    user_balance = totals['balances'][user_id]
+
+    user_payload = json.dumps({'group_uuid': group_uuid,
+                               'user': user_id,
                                })
 
-    # todo: probably unnecessary because of the verify author decorator
+    # the verify author decorator does not check that the author is this user, so this
+    # is the signature that actually authorizes the request
     try:  # verify the signatures
-        crypto.verify(user.key, user_signature, user_payload)
+        request.signatures.add(user_id, user_signature, user_payload)
+        request.signatures.verify()
     except (crypto.InvalidKey, crypto.InvalidSignature):
         logger.info('Request with invalid signature or key by author %s' % user_id)
         return HttpResponseForbidden()
 
+    if known_version is not None and known_version == totals['version']:
+        logger.info('Totals of user %s not modified' % user_id)
+        return _not_modified(group_uuid, user_id, totals['version'])
+
     # example: {'user1': val1, 'user2': val2}
     suggested_transactions = {}
 
     # todo: send the actual totals along with the suggested transactions
-    if user.balance < 0:  # filter by borrower
-        for debt in UserDebt.objects.filter(group=group, borrower=user):
-            suggested_transactions[debt.lender.key] = debt.value
-
-    elif user.balance > 0:  # filter by lender
-        for debt in UserDebt.objects.filter(group=group, lender=user):
-            suggested_transactions[debt.borrower.key] = debt.value
-
-    response = json.dumps({'group_uuid': str(group.uuid),
-                           'user': user.key,
-                           'user_balance': user.balance,
-                           'suggested_transactions': suggested_transactions,
-                           })
+    if user_balance < 0:  # the users this user owes to
+        suggested_transactions = totals['debts'].get(user_id, {})
+
+    elif user_balance > 0:  # the users that owe to this user
+        suggested_transactions = totals['credits'].get(user_id, {})
+
+    with timing.phase('json'):
+        response = json.dumps({'group_uuid': group_uuid,
+                               'user': user_id,
+                               'version': totals['version'],
+                               'user_balance': user_balance,
+                               'suggested_transactions': suggested_transactions,
+                               })
 
     logger.info('Totals sent to user %s' % user_id)
     return HttpResponse(response, status=200)
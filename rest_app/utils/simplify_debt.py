@@ -1,3 +1,4 @@
+import heapq
 from collections import defaultdict
 
 
@@ -34,38 +35,162 @@ def borrowers_and_lenders(totals_dict: dict) -> (dict, dict):
     return borrowers, lenders
 
 
-def debt_simplification(borrowers: dict, lenders: dict) -> dict:
+def _settle_in_order(borrowers: list, lenders: list, simplified_debt: dict) -> None:
     """
-    Inputs are two dictionaries containing borrowers and lenders.
-    The output is a list of simplified UOMe {lender, borrower, value}
+    Two-pointer matcher over lists of [user, amount] pairs: each borrower pays the
+    lenders in the given order until their debt is settled. Runs in O(L + B)
+    """
+
+    b, l = 0, 0
+    while b < len(borrowers) and l < len(lenders):
+        borrower, debit = borrowers[b]
+        lender, credit = lenders[l]
+
+        transaction_value = min(credit, debit)
+        simplified_debt[borrower][lender] = transaction_value
+
+        borrowers[b][1] -= transaction_value
+        lenders[l][1] -= transaction_value
+
+        if borrowers[b][1] == 0:
+            b += 1
+        if lenders[l][1] == 0:
+            l += 1
+
+
+def sorted_strategy(borrowers: dict, lenders: dict, previous_debt: dict) -> dict:
+    """
+    Settles the lenders by the order of their keys, each with the borrowers by the
+    order of their keys. The same balances always give the same output
+    """
+
+    simplified_debt = defaultdict(dict)
+    _settle_in_order([[user, borrowers[user]] for user in sorted(borrowers)],
+                     [[user, lenders[user]] for user in sorted(lenders)],
+                     simplified_debt)
+
+    return dict(simplified_debt)
+
+
+def fewest_transactions_strategy(borrowers: dict, lenders: dict,
+                                 previous_debt: dict) -> dict:
     """
+    Always settles the biggest remaining debt with the biggest remaining credit, so
+    that as many users as possible are settled with a single transaction
+    """
+
+    # heapq is a min-heap, so the amounts are negated. Ties are broken by user key
+    borrowers_heap = [(-debit, user) for user, debit in borrowers.items() if debit]
+    lenders_heap = [(-credit, user) for user, credit in lenders.items() if credit]
+    heapq.heapify(borrowers_heap)
+    heapq.heapify(lenders_heap)
 
     simplified_debt = defaultdict(dict)
-    for lender in sorted(lenders):
-        for borrower in sorted(borrowers):
-            credit, debit = lenders[lender], borrowers[borrower]
+    while borrowers_heap and lenders_heap:
+        debit, borrower = heapq.heappop(borrowers_heap)
+        credit, lender = heapq.heappop(lenders_heap)
+
+        transaction_value = min(-debit, -credit)
+        simplified_debt[borrower][lender] = transaction_value
+
+        if -debit > transaction_value:
+            heapq.heappush(borrowers_heap, (debit + transaction_value, borrower))
+        if -credit > transaction_value:
+            heapq.heappush(lenders_heap, (credit + transaction_value, lender))
+
+    return dict(simplified_debt)
+
+
+def stable_strategy(borrowers: dict, lenders: dict, previous_debt: dict) -> dict:
+    """
+    Keeps as much of the previous simplified debt as the new balances allow and only
+    settles what is left by the order of the keys. Accepting a UOMe then changes
+    only a few edges of the graph
+    """
+
+    remaining_debit = dict(borrowers)
+    remaining_credit = dict(lenders)
 
-            if credit != 0 and debit != 0:
-                transaction_value = min(credit, debit)
+    simplified_debt = defaultdict(dict)
+    for borrower in sorted(previous_debt):
+        for lender in sorted(previous_debt[borrower]):
+            transaction_value = min(previous_debt[borrower][lender],
+                                    remaining_debit.get(borrower, 0),
+                                    remaining_credit.get(lender, 0))
+            if transaction_value > 0:
                 simplified_debt[borrower][lender] = transaction_value
+                remaining_debit[borrower] -= transaction_value
+                remaining_credit[lender] -= transaction_value
 
-                if lenders[lender] >= borrowers[borrower]:
-                    lenders[lender] -= transaction_value
-                    borrowers[borrower] = 0
-                else:
-                    lenders[lender] = 0
-                    borrowers[borrower] -= transaction_value
+    _settle_in_order([[user, remaining_debit[user]] for user in sorted(remaining_debit)
+                      if remaining_debit[user]],
+                     [[user, remaining_credit[user]] for user in sorted(remaining_credit)
+                      if remaining_credit[user]],
+                     simplified_debt)
 
     return dict(simplified_debt)
 
 
-def update_total_debt(current_totals: defaultdict(int), new_uomes: list) -> (
+STRATEGIES = {
+    'sorted': sorted_strategy,
+    'fewest_transactions': fewest_transactions_strategy,
+    'stable': stable_strategy,
+}
+
+
+def debt_simplification(borrowers: dict, lenders: dict, strategy='sorted',
+                        previous_debt: dict = None) -> dict:
+    """
+    Inputs are two dictionaries containing borrowers and lenders.
+    The output is a list of simplified UOMe {lender, borrower, value}
+    The strategy is either the name of one in STRATEGIES or a function with the same
+    signature. The previous simplified debt is only used by strategies that try to
+    change it as little as possible
+    """
+
+    if not callable(strategy):
+        strategy = STRATEGIES[strategy]
+
+    return strategy(borrowers, lenders, previous_debt or {})
+
+
+def update_total_debt(current_totals: defaultdict(int), new_uomes: list,
+                      strategy='sorted', previous_debt: dict = None) -> (
 defaultdict(int), dict):
     """
     Get the new state of the user graph when given a list of new UOMe's
     """
 
     new_totals = compute_totals(current_totals, new_uomes)
-    new_user_debt = debt_simplification(*borrowers_and_lenders(new_totals))
+    new_user_debt = debt_simplification(*borrowers_and_lenders(new_totals),
+                                        strategy=strategy, previous_debt=previous_debt)
 
     return new_totals, new_user_debt
+
+
+def diff_simplified_debt(old_debt: dict, new_debt: dict) -> (list, list, list):
+    """
+    Compare two simplified debt graphs like {borrower: {lender: value}}.
+    Outputs are the edges that were added and the edges whose value changed, both as
+    [borrower, lender, value], and the edges that were removed, as [borrower, lender]
+    """
+
+    added = []
+    changed = []
+    removed = []
+
+    for borrower, debts in new_debt.items():
+        old_debts = old_debt.get(borrower, {})
+        for lender, value in debts.items():
+            if lender not in old_debts:
+                added.append([borrower, lender, value])
+            elif old_debts[lender] != value:
+                changed.append([borrower, lender, value])
+
+    for borrower, debts in old_debt.items():
+        new_debts = new_debt.get(borrower, {})
+        for lender in debts:
+            if lender not in new_debts:
+                removed.append([borrower, lender])
+
+    return added, changed, removed
@@ -1,6 +1,9 @@
+import random
 from collections import defaultdict
 
-from rest_app.utils import simplify_debt
+import pytest
+
+from rest_app.utils import cache, simplify_debt
 # TODO: add WAY more tests here
 
 
@@ -13,3 +16,148 @@ class TestSimplifyDebt:
 
         assert new_totals == {'B': 2, 'A': 1, 'C': -3}
         assert simplified_debt == {'C': {'B': 2, 'A': 1}}
+
+    def test_diff_simplified_debt(self):
+        old_debt = {'A': {'B': 5, 'C': 2}, 'D': {'B': 1}}
+        new_debt = {'A': {'B': 3}, 'D': {'B': 1, 'C': 4}, 'E': {'C': 2}}
+
+        added, changed, removed = simplify_debt.diff_simplified_debt(old_debt, new_debt)
+
+        assert sorted(added) == [['D', 'C', 4], ['E', 'C', 2]]
+        assert changed == [['A', 'B', 3]]
+        assert removed == [['A', 'C']]
+
+    def test_diff_simplified_debt_unchanged_graph(self):
+        debt = {'A': {'B': 5}}
+
+        assert simplify_debt.diff_simplified_debt(debt, debt) == ([], [], [])
+
+
+def _quadratic_debt_simplification(borrowers: dict, lenders: dict) -> dict:
+    # the original O(L*B) implementation, kept as a reference for the sorted strategy
+    simplified_debt = defaultdict(dict)
+    for lender in sorted(lenders):
+        for borrower in sorted(borrowers):
+            credit, debit = lenders[lender], borrowers[borrower]
+
+            if credit != 0 and debit != 0:
+                transaction_value = min(credit, debit)
+                simplified_debt[borrower][lender] = transaction_value
+                lenders[lender] -= transaction_value
+                borrowers[borrower] -= transaction_value
+
+    return dict(simplified_debt)
+
+
+def _random_totals(rng: random.Random, users: int) -> defaultdict(int):
+    uomes = [[str(rng.randrange(users)), str(rng.randrange(users)), rng.randint(1, 1000)]
+             for _ in range(users * 2)]
+    return simplify_debt.compute_totals(defaultdict(int), uomes)
+
+
+def _settled_totals(simplified_debt: dict) -> defaultdict(int):
+    totals = defaultdict(int)
+    for borrower, debts in simplified_debt.items():
+        for lender, value in debts.items():
+            totals[borrower] -= value
+            totals[lender] += value
+    return totals
+
+
+class TestSimplificationStrategies:
+    def test_sorted_matches_quadratic_implementation(self):
+        rng = random.Random(42)
+        for users in (2, 5, 30, 200):
+            borrowers, lenders = simplify_debt.borrowers_and_lenders(
+                _random_totals(rng, users))
+
+            expected = _quadratic_debt_simplification(dict(borrowers), dict(lenders))
+
+            assert simplify_debt.debt_simplification(borrowers, lenders) == expected
+
+    @pytest.mark.parametrize('strategy', sorted(simplify_debt.STRATEGIES))
+    def test_strategy_settles_all_balances(self, strategy):
+        rng = random.Random(7)
+        totals = _random_totals(rng, 50)
+        previous_debt = simplify_debt.debt_simplification(
+            *simplify_debt.borrowers_and_lenders(totals))
+        totals = simplify_debt.compute_totals(totals, [['1', '2', 300], ['3', '1', 20]])
+
+        simplified_debt = simplify_debt.debt_simplification(
+            *simplify_debt.borrowers_and_lenders(totals), strategy=strategy,
+            previous_debt=previous_debt)
+
+        settled = _settled_totals(simplified_debt)
+        assert {user: total for user, total in totals.items() if total} == \
+            {user: total for user, total in settled.items() if total}
+        assert all(value > 0 for debts in simplified_debt.values()
+                   for value in debts.values())
+
+    def test_fewest_transactions_settles_biggest_balances_first(self):
+        borrowers = {'A': 10, 'B': 5}
+        lenders = {'C': 5, 'D': 10}
+
+        simplified_debt = simplify_debt.debt_simplification(
+            borrowers, lenders, strategy='fewest_transactions')
+
+        assert simplified_debt == {'A': {'D': 10}, 'B': {'C': 5}}
+
+    def test_stable_keeps_previous_debt(self):
+        previous_debt = {'A': {'D': 5}, 'B': {'C': 5}}
+        borrowers = {'A': 6, 'B': 5}
+        lenders = {'C': 6, 'D': 5}
+
+        simplified_debt = simplify_debt.debt_simplification(
+            borrowers, lenders, strategy='stable', previous_debt=previous_debt)
+
+        # only one new edge, while the sorted strategy would replace every edge
+        assert simplified_debt == {'A': {'D': 5, 'C': 1}, 'B': {'C': 5}}
+        assert simplify_debt.debt_simplification(borrowers, lenders) == \
+            {'A': {'C': 6}, 'B': {'D': 5}}
+
+    def test_custom_strategy(self):
+        def nothing_strategy(borrowers, lenders, previous_debt):
+            return {}
+
+        assert simplify_debt.debt_simplification({'A': 1}, {'B': 1},
+                                                 strategy=nothing_strategy) == {}
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        assert lru.get('a') == 1  # 'b' is now the least recently used
+        lru.set('c', 3)
+
+        assert lru.get('b') is None
+        assert lru.get('a') == 1
+        assert lru.get('c') == 3
+        assert len(lru) == 2
+        assert (lru.hits, lru.misses) == (3, 1)
+
+    def test_entries_expire_after_ttl(self):
+        now = [0]
+        lru = cache.LRUCache(max_size=10, ttl=5, clock=lambda: now[0])
+        lru.set('a', 1)
+
+        now[0] = 4
+        assert lru.get('a') == 1
+        now[0] = 5
+        assert lru.get('a', 'missing') == 'missing'
+        assert len(lru) == 0
+
+    def test_invalidate(self):
+        lru = cache.LRUCache(max_size=10)
+        lru.set('a', 1)
+        lru.invalidate('a')
+        lru.invalidate('b')
+
+        assert lru.get('a') is None
+
+    def test_disabled_cache(self):
+        lru = cache.LRUCache(max_size=0)
+        lru.set('a', 1)
+
+        assert lru.get('a') is None
@@ -0,0 +1,21 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from rest_app import metrics
+
+
+def expose_metrics(request):
+    """
+    The metrics of this process in the Prometheus text format. Unsigned, so they are
+    only served to requests with settings.METRICS_TOKEN as their bearer token, and to
+    nobody when there is no token
+    """
+    token = 'Bearer %s' % settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not settings.METRICS_TOKEN or not hmac.compare_digest(authorization.encode(),
+                                                             token.encode()):
+        return HttpResponseForbidden()
+
+    return HttpResponse(metrics.expose(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,182 @@
+"""
+Benchmark of rest_app.utils.simplify_debt with groups of growing size and synthetic,
+seeded UOMe distributions. Reports the wall time of compute_totals,
+borrowers_and_lenders and debt_simplification (with each strategy), the peak memory
+of the whole computation and the number of edges of the simplified debt.
+
+Run it from the root of the project:
+
+    python -m scripts.bench_simplify_debt [--sizes 10 1000 100000] [--output results.json]
+
+The results of two runs can be compared by their JSON output files.
+"""
+import argparse
+import itertools
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from collections import defaultdict
+
+from rest_app.utils import simplify_debt
+
+UOMES_PER_USER = 5
+MAX_VALUE = 10000  # in cents
+
+
+def uniform(rng: random.Random, users: list, count: int) -> list:
+    """
+    Any user lends to any other with the same probability
+    """
+    uomes = []
+    for _ in range(count):
+        borrower, lender = rng.sample(users, 2)
+        uomes.append([borrower, lender, rng.randint(1, MAX_VALUE)])
+    return uomes
+
+
+def skewed(rng: random.Random, users: list, count: int) -> list:
+    """
+    A few users take part in most UOMe's, with Zipf-like weights, and the values
+    follow a long-tailed distribution
+    """
+    # cumulative, so that choices() doesn't add up all the weights in every call
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(users) + 1)))
+    uomes = []
+    for _ in range(count):
+        borrower, lender = rng.choices(users, cum_weights=weights, k=2)
+        while lender == borrower:
+            lender = rng.choices(users, cum_weights=weights)[0]
+        value = min(int(rng.paretovariate(1.5) * 100), MAX_VALUE * 10)
+        uomes.append([borrower, lender, value])
+    return uomes
+
+
+def few_big_lenders(rng: random.Random, users: list, count: int) -> list:
+    """
+    1% of the users (at least 1) are the lenders of most UOMe's, e.g. whoever pays the
+    rent and the bills of the group
+    """
+    lenders = users[:max(1, len(users) // 100)]
+    uomes = []
+    for _ in range(count):
+        if rng.random() < 0.9:
+            lender = rng.choice(lenders)
+            borrower = rng.choice(users)
+            while borrower == lender:
+                borrower = rng.choice(users)
+        else:
+            borrower, lender = rng.sample(users, 2)
+        uomes.append([borrower, lender, rng.randint(1, MAX_VALUE)])
+    return uomes
+
+
+DISTRIBUTIONS = {
+    'uniform': uniform,
+    'skewed': skewed,
+    'few_big_lenders': few_big_lenders,
+}
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run(distribution: str, size: int, seed: int, repeat: int) -> dict:
+    """
+    Runs the benchmark for one distribution and group size. Times are the best of
+    `repeat` runs, the peak memory is measured in a run of its own since tracemalloc
+    slows everything down
+    """
+    rng = random.Random('%s-%d-%d' % (distribution, size, seed))
+    users = ['user-%d' % i for i in range(size)]
+    uomes = DISTRIBUTIONS[distribution](rng, users, size * UOMES_PER_USER)
+
+    # the last 1% of the UOMe's are accepted after the rest, for the stable strategy
+    last = max(1, len(uomes) // 100)
+    previous_totals = simplify_debt.compute_totals(defaultdict(int), uomes[:-last])
+    previous_debt = simplify_debt.debt_simplification(
+        *simplify_debt.borrowers_and_lenders(previous_totals))
+
+    def simplify():
+        totals, compute_time = timed(simplify_debt.compute_totals, defaultdict(int), uomes)
+        (borrowers, lenders), split_time = timed(simplify_debt.borrowers_and_lenders,
+                                                 totals)
+        times = {'compute_totals': compute_time, 'borrowers_and_lenders': split_time}
+        edges = {}
+        for strategy in sorted(simplify_debt.STRATEGIES):
+            debt, times[strategy] = timed(simplify_debt.debt_simplification,
+                                          borrowers, lenders, strategy=strategy,
+                                          previous_debt=previous_debt)
+            edges[strategy] = sum(len(debts) for debts in debt.values())
+        return times, edges, len(borrowers), len(lenders)
+
+    best_times = None
+    for _ in range(repeat):
+        times, edges, borrowers, lenders = simplify()
+        if best_times is None:
+            best_times = times
+        else:
+            best_times = {name: min(best_times[name], times[name]) for name in times}
+
+    tracemalloc.start()
+    simplify()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'distribution': distribution, 'users': size, 'uomes': len(uomes),
+            'borrowers': borrowers, 'lenders': lenders,
+            'seconds': {name: round(seconds, 6) for name, seconds in best_times.items()},
+            'peak_memory_bytes': peak_memory, 'edges': edges}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000],
+                        help='numbers of users of the groups')
+    parser.add_argument('--distributions', nargs='+', choices=sorted(DISTRIBUTIONS),
+                        default=sorted(DISTRIBUTIONS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    strategies = sorted(simplify_debt.STRATEGIES)
+    print('%-16s %8s %10s %10s %10s' % ('distribution', 'users', 'totals (s)',
+                                        'split (s)', 'peak (KiB)')
+          + ''.join(' %22s' % ('%s (s/edges)' % strategy) for strategy in strategies))
+
+    results = []
+    for distribution in args.distributions:
+        for size in args.sizes:
+            result = run(distribution, size, args.seed, args.repeat)
+            results.append(result)
+            print('%-16s %8d %10.4f %10.4f %10d' % (
+                distribution, size, result['seconds']['compute_totals'],
+                result['seconds']['borrowers_and_lenders'],
+                result['peak_memory_bytes'] // 1024)
+                + ''.join(' %22s' % ('%.4f/%d' % (result['seconds'][strategy],
+                                                  result['edges'][strategy]))
+                          for strategy in strategies))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'revision': git_revision(), 'python': platform.python_version(),
+                       'seed': args.seed, 'repeat': args.repeat, 'results': results},
+                      output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Benchmark of the get-totals read throughput of a SQLite database while accepts are
+being written, with the default SQLite settings and with settings.SQLITE_PRAGMAS.
+The totals cache is disabled, so that every get-totals reads the database.
+
+Run it from the root of the project, where server_keys.pem is:
+
+    python -m scripts.bench_sqlite [--seconds 10] [--readers 4] [--output results.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MODES = ('default', 'tuned')
+
+
+def signed_request(private_key, key, payload: dict) -> dict:
+    import groupbank_crypto.ec_secp256k1 as crypto
+
+    payload = json.dumps(payload)
+    return {'author': key, 'signature': crypto.sign(private_key, payload), 'payload': payload}
+
+
+def run(mode: str, db_path: str, seconds: float, readers: int, uomes: int) -> dict:
+    """
+    Runs the benchmark in this process against a new database at db_path
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'global_server.settings')
+
+    import django
+    from django.conf import settings
+
+    settings.DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3',
+                                     'NAME': db_path}
+    if mode == 'default':
+        settings.SQLITE_PRAGMAS = {}
+    # otherwise get-totals would only read the database after each accept
+    settings.TOTALS_CACHE = dict(settings.TOTALS_CACHE, BACKEND=None, MAX_SIZE=0)
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db import OperationalError, connection
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    from django.urls import reverse
+
+    import groupbank_crypto.ec_secp256k1 as crypto
+    from rest_app.models import Group, User, UOMe
+
+    setup_test_environment()
+    call_command('migrate', verbosity=0)
+
+    _, group_key = crypto.generate_keys()
+    reader_priv, reader_key = crypto.generate_keys()
+    borrower_priv, borrower_key = crypto.generate_keys()
+
+    group = Group.objects.create(name='bench', key=group_key)
+    User.objects.create(group=group, key=reader_key)
+    borrower = User.objects.create(group=group, key=borrower_key)
+    lenders = [User.objects.create(group=group, key='lender-%d' % i) for i in range(10)]
+
+    auth_payload = json.dumps({'group_uuid': str(group.uuid), 'user': reader_key})
+    totals_request = signed_request(reader_priv, reader_key, {
+        'group_uuid': str(group.uuid),
+        'user': reader_key,
+        'user_signature': crypto.sign(reader_priv, auth_payload),
+    })
+
+    accept_requests = []
+    for i in range(uomes):
+        uome = UOMe.objects.create(group=group, borrower=borrower, lender=lenders[i % 10],
+                                   value=i + 1, description='bench',
+                                   issuer_signature='bench')
+        borrower_payload = json.dumps({'group_uuid': str(group.uuid),
+                                       'issuer': uome.lender_id,
+                                       'borrower': borrower_key,
+                                       'value': uome.value,
+                                       'description': uome.description,
+                                       'uome_uuid': str(uome.uuid),
+                                       })
+        accept_requests.append(signed_request(borrower_priv, borrower_key, {
+            'group_uuid': str(group.uuid),
+            'user': borrower_key,
+            'uome_uuid': str(uome.uuid),
+            'user_signature': crypto.sign(borrower_priv, borrower_payload),
+        }))
+
+    connection.close()
+
+    counts = {'reads': 0, 'writes': 0, 'read_errors': 0, 'write_errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def count(name):
+        with lock:
+            counts[name] += 1
+
+    def reader():
+        client = Client()
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    ok = client.post(reverse('rest:uome:get-totals'),
+                                     totals_request).status_code == 200
+                except OperationalError:  # database is locked
+                    ok = False
+                count('reads' if ok else 'read_errors')
+        finally:
+            connection.close()
+
+    def writer():
+        client = Client()
+        try:
+            for data in accept_requests:
+                if time.monotonic() >= deadline:
+                    break
+                try:
+                    ok = client.post(reverse('rest:uome:accept'), data).status_code == 200
+                except OperationalError:  # database is locked
+                    ok = False
+                count('writes' if ok else 'write_errors')
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    return dict(counts, mode=mode, seconds=round(elapsed, 3), readers=readers,
+                reads_per_second=round(counts['reads'] / elapsed, 1),
+                writes_per_second=round(counts['writes'] / elapsed, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--uomes', type=int, default=1000,
+                        help='number of UOMes the writer can accept')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:  # a single run, in a process of its own
+        print(json.dumps(run(args.mode, args.db, args.seconds, args.readers, args.uomes)))
+        return
+
+    results = []
+    for mode in MODES:
+        # each mode needs a new process, since the settings are read at setup
+        with tempfile.TemporaryDirectory() as directory:
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'scripts.bench_sqlite', '--mode', mode,
+                 '--db', os.path.join(directory, 'bench.sqlite3'),
+                 '--seconds', str(args.seconds), '--readers', str(args.readers),
+                 '--uomes', str(args.uomes)])
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    print('%-8s %12s %12s %12s %12s' % ('mode', 'reads/s', 'writes/s', 'read errors',
+                                        'write errors'))
+    for result in results:
+        print('%-8s %12s %12s %12s %12s' % (result['mode'], result['reads_per_second'],
+                                            result['writes_per_second'],
+                                            result['read_errors'], result['write_errors']))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
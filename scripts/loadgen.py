@@ -0,0 +1,295 @@
+"""
+Load generator for a running server. Drives the whole life of UOMe's with signed
+requests, from many groups and users at once: issue, confirm, get-pending (by the
+borrower), accept and get-totals. Reports the throughput and the p50/p95/p99 latency
+of each endpoint.
+
+The workload (keys, groups, users and the schedule of the UOMe's) is generated from a
+seed, and can be recorded to a traffic file with --record and replayed later, against
+a new database, with --replay:
+
+    python -m scripts.loadgen --url http://localhost:8080 [--groups 10] [--users 10]
+                              [--uomes 1000] [--rate 50] [--concurrency 32]
+                              [--record traffic.json | --replay traffic.json]
+                              [--output results.json]
+
+The requests that only depend on the keys and the group uuids are signed before the
+load starts. Confirm and accept sign the uuid the server gives to each UOMe, so they
+are signed during the run, outside of the measured latency.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import groupbank_crypto.ec_secp256k1 as crypto
+
+ENDPOINTS = ('issue', 'confirm', 'get-pending', 'accept', 'get-totals')
+
+
+def generate(seed: int, groups: int, users: int, uomes: int, rate: float) -> dict:
+    """
+    Generates a workload of `uomes` UOMe's between the users of the groups, started
+    at `rate` UOMe's per second
+    """
+    rng = random.Random(seed)
+
+    def new_keys():
+        private_key, key = crypto.generate_keys()
+        return {'private_key': private_key, 'key': key}
+
+    traffic = {'seed': seed, 'rate': rate, 'groups': [], 'uomes': []}
+    for group in range(groups):
+        traffic['groups'].append(dict(new_keys(), name='loadgen-%d' % group,
+                                      users=[new_keys() for _ in range(users)]))
+
+    for i in range(uomes):
+        lender, borrower = rng.sample(range(users), 2)
+        traffic['uomes'].append({'at': i / rate,
+                                 'group': rng.randrange(groups),
+                                 'lender': lender,
+                                 'borrower': borrower,
+                                 'value': rng.randint(1, 10000),
+                                 'description': 'loadgen %d' % i})
+
+    return traffic
+
+
+def envelope(private_key: str, key: str, payload: dict) -> dict:
+    payload = json.dumps(payload)
+    return {'author': key, 'signature': crypto.sign(private_key, payload),
+            'payload': payload}
+
+
+def auth_request(group_uuid: str, user: dict) -> dict:
+    """
+    A get-pending or get-totals request, which only depend on the group and the user
+    """
+    auth_payload = json.dumps({'group_uuid': group_uuid, 'user': user['key']})
+    return envelope(user['private_key'], user['key'], {
+        'group_uuid': group_uuid,
+        'user': user['key'],
+        'user_signature': crypto.sign(user['private_key'], auth_payload),
+    })
+
+
+class LoadGenerator(object):
+
+    def __init__(self, url: str, traffic: dict):
+        self.url = url.rstrip('/')
+        self.traffic = traffic
+
+        self.latencies = defaultdict(list)  # endpoint -> seconds
+        self.statuses = defaultdict(lambda: defaultdict(int))  # endpoint -> status -> n
+        self._lock = threading.Lock()
+
+    def post(self, path: str, data: dict, endpoint: str = None) -> (int, dict):
+        """
+        Posts a signed request and returns the status and the JSON body of the
+        response. Only the requests with an endpoint are measured
+        """
+        request = urllib.request.Request(self.url + path,
+                                         urllib.parse.urlencode(data).encode())
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as error:
+            status, body = error.code, error.read()
+        except OSError:
+            status, body = 'error', b''
+        latency = time.perf_counter() - start
+
+        if endpoint is not None:
+            with self._lock:
+                self.latencies[endpoint].append(latency)
+                self.statuses[endpoint][status] += 1
+
+        try:
+            return status, json.loads(body.decode())
+        except ValueError:
+            return status, None
+
+    def register(self) -> None:
+        """
+        Registers the groups and the users of the traffic, and signs the get-pending
+        and get-totals requests of every user
+        """
+        for group in self.traffic['groups']:
+            status, response = self.post('/rest/group/register/', envelope(
+                group['private_key'], group['key'],
+                {'group_name': group['name'], 'group_key': group['key']}))
+            if status != 201:
+                raise RuntimeError('Could not register group %s: %s' % (group['name'],
+                                                                          status))
+            group['uuid'] = response['group_uuid']
+
+            for user in group['users']:
+                status, _ = self.post('/rest/group/register-user/', envelope(
+                    group['private_key'], group['key'],
+                    {'group_uuid': group['uuid'], 'user_key': user['key']}))
+                if status != 201:
+                    raise RuntimeError('Could not register a user of group %s: %s'
+                                       % (group['name'], status))
+                user['auth_request'] = auth_request(group['uuid'], user)
+
+    def prepare_issue(self, uome: dict) -> dict:
+        group = self.traffic['groups'][uome['group']]
+        lender = group['users'][uome['lender']]
+        auth_payload = json.dumps({'group_uuid': group['uuid'], 'user': lender['key']})
+        return envelope(lender['private_key'], lender['key'], {
+            'group_uuid': group['uuid'],
+            'user': lender['key'],
+            'borrower': group['users'][uome['borrower']]['key'],
+            'value': uome['value'],
+            'description': uome['description'],
+            'user_signature': crypto.sign(lender['private_key'], auth_payload),
+        })
+
+    def run_uome(self, uome: dict, issue_request: dict, start: float) -> None:
+        """
+        Goes through the whole life of an UOMe, starting at its scheduled time
+        """
+        delay = start + uome['at'] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        group = self.traffic['groups'][uome['group']]
+        lender = group['users'][uome['lender']]
+        borrower = group['users'][uome['borrower']]
+
+        status, response = self.post('/rest/uome/issue/', issue_request, 'issue')
+        if status != 201:
+            return
+        uome_uuid = response['uome_uuid']
+
+        uome_payload = json.dumps({'group_uuid': group['uuid'],
+                                   'user': lender['key'],
+                                   'borrower': borrower['key'],
+                                   'value': uome['value'],
+                                   'description': uome['description'],
+                                   'uome_uuid': uome_uuid,
+                                   })
+        status, _ = self.post('/rest/uome/confirm/', envelope(
+            lender['private_key'], lender['key'], {
+                'group_uuid': group['uuid'],
+                'user': lender['key'],
+                'uome_uuid': uome_uuid,
+                'user_signature': crypto.sign(lender['private_key'], uome_payload),
+            }), 'confirm')
+        if status != 200:
+            return
+
+        self.post('/rest/uome/get-pending/', borrower['auth_request'], 'get-pending')
+
+        borrower_payload = json.dumps({'group_uuid': group['uuid'],
+                                       'issuer': lender['key'],
+                                       'borrower': borrower['key'],
+                                       'value': uome['value'],
+                                       'description': uome['description'],
+                                       'uome_uuid': uome_uuid,
+                                       })
+        status, _ = self.post('/rest/uome/accept/', envelope(
+            borrower['private_key'], borrower['key'], {
+                'group_uuid': group['uuid'],
+                'user': borrower['key'],
+                'uome_uuid': uome_uuid,
+                'user_signature': crypto.sign(borrower['private_key'], borrower_payload),
+            }), 'accept')
+        if status != 200:
+            return
+
+        self.post('/rest/uome/get-totals/', borrower['auth_request'], 'get-totals')
+
+    def run(self, concurrency: int) -> dict:
+        self.register()
+        issue_requests = [self.prepare_issue(uome) for uome in self.traffic['uomes']]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            futures = [executor.submit(self.run_uome, uome, issue_request, start)
+                       for uome, issue_request in zip(self.traffic['uomes'],
+                                                      issue_requests)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        results = {'seconds': round(elapsed, 3), 'endpoints': {}}
+        for endpoint in ENDPOINTS:
+            latencies = sorted(self.latencies[endpoint])
+            results['endpoints'][endpoint] = {
+                'requests': len(latencies),
+                'statuses': {str(status): count
+                             for status, count in self.statuses[endpoint].items()},
+                'requests_per_second': round(len(latencies) / elapsed, 1),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+            }
+        return results
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list of seconds, in milliseconds
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, int(round(percent / 100 * len(sorted_values))) - 1)
+    return round(sorted_values[rank] * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--users', type=int, default=10, help='users of each group')
+    parser.add_argument('--uomes', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=50,
+                        help='UOMe\'s started per second')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='UOMe\'s in flight at once')
+    traffic_file = parser.add_mutually_exclusive_group()
+    traffic_file.add_argument('--record', help='write the workload to this file')
+    traffic_file.add_argument('--replay', help='read the workload from this file')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as input_file:
+            traffic = json.load(input_file)
+    else:
+        traffic = generate(args.seed, args.groups, args.users, args.uomes, args.rate)
+        if args.record:
+            with open(args.record, 'w') as output_file:
+                json.dump(traffic, output_file, indent=2)
+
+    results = LoadGenerator(args.url, traffic).run(args.concurrency)
+
+    print('%-12s %9s %9s %9s %9s %9s %8s' % ('endpoint', 'requests', 'req/s',
+                                             'p50 (ms)', 'p95 (ms)', 'p99 (ms)',
+                                             'errors'))
+    for endpoint, result in results['endpoints'].items():
+        errors = sum(count for status, count in result['statuses'].items()
+                     if not status.startswith('2'))
+        print('%-12s %9d %9s %9s %9s %9s %8d' % (
+            endpoint, result['requests'], result['requests_per_second'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'], errors))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()